@@ -0,0 +1,48 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class MemoryBroker:
+    '''
+    In-process stand-in for MessageBroker with the same stream semantics, for
+    running without Redis (e.g., tests or a single process deployment)
+    '''
+    def __init__(self, maxlen=1000):
+        self._maxlen = maxlen
+        self._streams = dict()
+        self._sequence = 0
+        self._changed = threading.Condition()
+
+    def publish(self, topic, message):
+        with self._changed:
+            self._sequence += 1
+            stream = self._streams.setdefault(topic, list())
+            stream.append((f'{self._sequence}-0', message))
+            del stream[:-self._maxlen]
+            self._changed.notify_all()
+        logger.info('message published successfully')
+
+    def last_id(self, topic):
+        with self._changed:
+            stream = self._streams.get(topic)
+            return stream[-1][0] if stream else '0-0'
+
+    def read(self, topic, last_id, block=5000):
+        last = int(last_id.split('-')[0])
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.after(topic, last),
+                timeout=block / 1000
+            )
+            return self.after(topic, last)
+
+    def stats(self):
+        return {
+            'available': True,
+            'commands': dict()
+        }
+
+    def after(self, topic, last):
+        stream = self._streams.get(topic, list())
+        return [(id, message) for id,message in stream if int(id.split('-')[0]) > last]
@@ -1,29 +1,167 @@
 import sys
+import time
 import redis
 import logging
+import threading
 import redis.exceptions
 
 logger = logging.getLogger(__name__)
 
+# messages are kept in a capped stream, older entries are trimmed
+STREAM_MAXLEN = 1000
+
+class BrokerUnavailable(Exception):
+    pass
+
 class MessageBroker:
-    def __init__(self, host='localhost', port=6379):
+    '''
+    All Redis traffic goes through one connection pool with short timeouts.
+    When a call fails the circuit opens: later calls fail immediately, and a
+    background thread pings Redis with exponential backoff until it answers,
+    so an outage never blocks the caller for longer than a single timeout.
+    '''
+    def __init__(self, host='localhost', port=6379, socket_timeout=1.0, connect_timeout=0.25,
+                 health_check_interval=30, max_connections=8, max_backoff=30.0):
         self._host = host
         self._port = port
+        self._socket_timeout = socket_timeout
+        self._connect_timeout = connect_timeout
+        self._health_check_interval = health_check_interval
+        self._max_connections = max_connections
+        self._max_backoff = max_backoff
         self._conn = None
         self._uri = f'redis://{self._host}:{self._port}'
+        self._lock = threading.Lock()
+        self._open = False
+        self._stats = dict()
         self.connect()
 
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            host=config.find_one('$.broker.host', default='127.0.0.1'),
+            port=config.find_one('$.broker.port', default=6379),
+            socket_timeout=config.find_one('$.broker.socket_timeout', default=1.0),
+            connect_timeout=config.find_one('$.broker.connect_timeout', default=0.25),
+            health_check_interval=config.find_one('$.broker.health_check_interval', default=30),
+            max_connections=config.find_one('$.broker.max_connections', default=8),
+            max_backoff=config.find_one('$.broker.max_backoff', default=30.0)
+        )
+
     def connect(self):
-        self._conn = redis.Redis(
+        self._pool = redis.ConnectionPool(
             host=self._host,
             port=self._port,
+            socket_timeout=self._socket_timeout,
+            socket_connect_timeout=self._connect_timeout,
+            health_check_interval=self._health_check_interval,
+            max_connections=self._max_connections,
             decode_responses=True
         )
+        self._conn = redis.Redis(connection_pool=self._pool)
+
+    def call(self, command, *args, **kwargs):
+        if self._open:
+            raise BrokerUnavailable(f'{self._uri} is unavailable')
+        start = time.perf_counter()
+        failed = False
+        try:
+            return getattr(self._conn, command)(*args, **kwargs)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+            failed = True
+            self.trip(e)
+            raise BrokerUnavailable(f'{self._uri} is unavailable') from e
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats.setdefault(command, {'calls': 0, 'failures': 0, 'seconds': 0.0})
+                stats['calls'] += 1
+                stats['failures'] += failed
+                stats['seconds'] += elapsed
+
+    def trip(self, error):
+        with self._lock:
+            if self._open:
+                return
+            self._open = True
+        logger.warning(f'lost connection to {self._uri} ({error}), reconnecting in the background')
+        threading.Thread(
+            target=self.reconnect,
+            name='broker-reconnect',
+            daemon=True
+        ).start()
+
+    def reconnect(self):
+        backoff = 0.5
+        while True:
+            time.sleep(backoff)
+            try:
+                self._conn.ping()
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                backoff = min(backoff * 2, self._max_backoff)
+                logger.debug(f'{self._uri} still unavailable, retrying in {backoff} seconds')
+                continue
+            with self._lock:
+                self._open = False
+            logger.info(f'reconnected to {self._uri}')
+            return
+
+    def stats(self):
+        '''
+        Calls, failures and seconds spent per Redis command. Blocking reads
+        count the time spent waiting for messages.
+        '''
+        with self._lock:
+            stats = {command: dict(values) for command,values in self._stats.items()}
+            return {
+                'available': not self._open,
+                'commands': stats
+            }
 
     def publish(self, topic, message):
         try:
-            self._conn.set(topic, message)
+            self.call(
+                'xadd',
+                topic,
+                {'message': message},
+                maxlen=STREAM_MAXLEN,
+                approximate=True
+            )
             logger.info('message published successfully')
-        except redis.exceptions.ConnectionError as e:
+        except BrokerUnavailable as e:
             logger.error(f'unable to send message to {self._uri}, service unavailable')
             pass
+
+    def last_id(self, topic):
+        '''
+        Id of the newest message on a topic, so that a reader only receives
+        messages published after it started. Returns None if Redis is
+        unavailable.
+        '''
+        try:
+            entries = self.call('xrevrange', topic, count=1)
+        except BrokerUnavailable as e:
+            logger.warning(f'unable to read from {self._uri}, service unavailable')
+            return None
+        if not entries:
+            return '0-0'
+        return entries[0][0]
+
+    def read(self, topic, last_id, block=5000):
+        '''
+        Return a list of (id, message) published after last_id, in order,
+        waiting up to block milliseconds for at least one to arrive. The wait
+        is kept below the socket timeout so an idle stream is not mistaken for
+        a dead connection.
+        '''
+        block = max(1, min(block, int(self._socket_timeout * 800)))
+        try:
+            response = self.call('xread', {topic: last_id}, block=block)
+        except BrokerUnavailable as e:
+            time.sleep(block / 1000)
+            return list()
+        messages = list()
+        for _,entries in response or list():
+            for id,fields in entries:
+                messages.append((id, fields.get('message')))
+        return messages
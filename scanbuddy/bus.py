@@ -0,0 +1,159 @@
+import queue
+import logging
+import threading
+import functools
+from pubsub import pub
+from scanbuddy.topics import topic
+
+logger = logging.getLogger(__name__)
+
+# block: wait for room, so a slow stage slows down whoever publishes to it
+# drop: discard the message when the queue is full
+# latest: keep only the most recent message (per key) that is not delivered yet
+POLICIES = ('block', 'drop', 'latest')
+
+class Stage:
+    '''
+    One pipeline component behind a bounded queue. A dedicated thread
+    delivers the messages of every topic the stage subscribed to, in the
+    order they were published, so a publisher only waits for a slow stage
+    when its queue is full. An exception in a listener is logged and the
+    next message is delivered.
+    '''
+    def __init__(self, name, namespace=None, maxsize=64):
+        self.name = name
+        self.namespace = namespace
+        self._maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._latest = dict()
+        self._listeners = list()
+        self._dropped = 0
+        self._coalesced = 0
+        self._delivered = 0
+        self._thread = threading.Thread(
+            target=self.run,
+            name=f'stage-{topic(name, namespace)}',
+            daemon=True
+        )
+        self._thread.start()
+
+    def subscribe(self, listener, name, policy='block', key=None):
+        '''
+        Deliver messages of a topic to listener on this stage's thread. With
+        the latest policy, messages are coalesced by the value of their key
+        argument (e.g., series), or all into one without a key.
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f'unknown policy "{policy}", expected one of {POLICIES}')
+        # pypubsub reads the signature of the wrapped listener, so the topic
+        # keeps the same message data specification
+        @functools.wraps(listener)
+        def enqueue(**kwargs):
+            self.put(listener, policy, key, kwargs)
+        # pypubsub only holds weak references to listeners
+        self._listeners.append(enqueue)
+        pub.subscribe(enqueue, topic(name, self.namespace))
+
+    def put(self, listener, policy, key, kwargs):
+        if threading.current_thread() is self._thread:
+            # waiting on our own queue would never return
+            self.deliver(listener, kwargs)
+            return
+        if policy == 'latest':
+            slot = (listener, kwargs.get(key) if key else None)
+            with self._lock:
+                pending = slot in self._latest
+                self._latest[slot] = kwargs
+                if pending:
+                    self._coalesced += 1
+                    return
+            self._queue.put((listener, slot, None))
+            return
+        if policy == 'drop':
+            try:
+                self._queue.put_nowait((listener, None, kwargs))
+            except queue.Full:
+                with self._lock:
+                    self._dropped += 1
+                logger.debug(f'dropping message for {listener.__name__}, {self.name} queue is full')
+            return
+        self._queue.put((listener, None, kwargs))
+
+    def run(self):
+        while True:
+            listener,slot,kwargs = self._queue.get()
+            try:
+                if slot is not None:
+                    with self._lock:
+                        kwargs = self._latest.pop(slot)
+                self.deliver(listener, kwargs)
+            finally:
+                self._queue.task_done()
+
+    def deliver(self, listener, kwargs):
+        try:
+            listener(**kwargs)
+        except Exception as e:
+            logger.error(f'{self.name} listener {listener.__name__} failed: {e}')
+            logger.exception(e, exc_info=True)
+        with self._lock:
+            self._delivered += 1
+
+    def join(self):
+        self._queue.join()
+
+    def pending(self):
+        '''
+        Messages that are queued or still being delivered. A message is
+        only finished after its listener returns, so anything the listener
+        published to another stage is already counted there.
+        '''
+        with self._queue.mutex:
+            return self._queue.unfinished_tasks
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self._queue.qsize(),
+                'maxsize': self._maxsize,
+                'delivered': self._delivered,
+                'dropped': self._dropped,
+                'coalesced': self._coalesced
+            }
+
+class Bus:
+    '''
+    Every stage of every scanner, for queue depth reporting and for waiting
+    until the pipeline is idle
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = list()
+
+    def stage(self, name, namespace=None, maxsize=64):
+        stage = Stage(name, namespace, maxsize)
+        with self._lock:
+            self._stages.append(stage)
+        return stage
+
+    def stats(self, namespace=None):
+        with self._lock:
+            stages = list(self._stages)
+        return {
+            stage.name: stage.stats()
+            for stage in stages if stage.namespace == (namespace or None)
+        }
+
+    def join(self):
+        '''
+        Wait until every stage is idle. Stages publish to each other, so
+        this repeats until a pass finds nothing queued or being delivered.
+        '''
+        with self._lock:
+            stages = list(self._stages)
+        while any(stage.pending() for stage in stages):
+            for stage in stages:
+                stage.join()
+
+bus = Bus()
@@ -1,72 +1,289 @@
 import time
 import math
-import json
 import logging
+import threading
 import numpy as np
 from pubsub import pub
-from sortedcontainers import SortedDict
+from pathlib import Path
+from collections import OrderedDict
+from scanbuddy.config import ConfigError
+from scanbuddy.bus import bus
+from scanbuddy.topics import topic
+from scanbuddy.timing import for_namespace
+from scanbuddy.proc.instances import Instances, InstanceTable, MAX_INSTANCE, is_valid, freeze, dumps
+from scanbuddy.proc.motion import MotionStore
+from scanbuddy.proc.persist import MotionFile, prune
 
 logger = logging.getLogger(__name__)
 
+REFERENCES = ('chain', 'fixed')
+
+class Series:
+    '''
+    Pipeline state for one series: its instances by InstanceNumber, motion
+    store, registration base and motion file. instances is the working table
+    the registration tasks are made from, published holds the immutable
+    snapshots handed to everything else.
+    '''
+    def __init__(self, uid, study=None):
+        self.uid = uid
+        self.study = study
+        self.subtitle = None
+        self.instances = InstanceTable(uid)
+        self.published = Instances(uid)
+        self.motion = MotionStore()
+        self.base = None
+        self.file = None
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+
 class Processor:
-    def __init__(self):
-        self.reset()
-        pub.subscribe(self.reset, 'reset')
-        pub.subscribe(self.listener, 'incoming')
+    def __init__(self, config=None, namespace=None):
+        self._namespace = namespace
+        self._timings = for_namespace(namespace)
+        self._reference = 'chain'
+        self._base_index = None
+        self._motion_dir = Path.home() / '.scanbuddy' / 'motion'
+        self._persist = True
+        self._retention = 7
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        if config:
+            self._reference = config.find_one('$.volreg.reference.mode', default='chain')
+            self._base_index = config.find_one('$.volreg.reference.index', default=None)
+            self._motion_dir = Path(config.find_one('$.motion.directory', default=self._motion_dir)).expanduser()
+            self._persist = config.find_one('$.motion.persist', default=True)
+            self._retention = config.find_one('$.motion.retention', default=7)
+        if self._reference not in REFERENCES:
+            raise ConfigError(f'unknown volreg reference mode "{self._reference}", expected one of {REFERENCES}')
+        logger.info(f'using {self._reference} volume registration reference mode')
+        self._stage = bus.stage('processor', namespace)
+        self._stage.subscribe(self.reset, 'reset')
+        self._stage.subscribe(self.evict, 'evict')
+        self._stage.subscribe(self.listener, 'incoming')
+        self._stage.subscribe(self.recover, 'recover')
+        # delivered on the registration worker that produced the result, a
+        # worker must never wait on the processor queue while the processor
+        # may be waiting on the registration queue
+        pub.subscribe(self.registered, topic('registered', namespace))
 
     def reset(self):
-        self._instances = SortedDict()
+        self._timings.log_summary()
+        self._timings.clear()
+        with self._lock:
+            series,self._series = self._series,OrderedDict()
+        for state in series.values():
+            state.close()
         logger.debug('received message to reset')
 
+    def evict(self, series):
+        '''
+        Forget a series that the watcher is no longer tracking
+        '''
+        with self._lock:
+            state = self._series.pop(series, None)
+        if state:
+            logger.info(f'evicting series {series} with {len(state.instances)} volumes')
+            state.close()
+
+    def series(self, uid=None):
+        '''
+        State for a series, the newest series without a uid, None if there is
+        no such series
+        '''
+        with self._lock:
+            if uid is None:
+                return next(reversed(self._series.values()), None)
+            return self._series.get(uid)
+
+    def active(self):
+        with self._lock:
+            return list(self._series.values())
+
+    def open_series(self, ds, load=False):
+        '''
+        Create the state for a new series and open its motion file. With
+        load (recovery after a restart), parameters already on disk are
+        loaded into the motion store, otherwise the series is starting over
+        and they are discarded. Motion files of other series older than the
+        retention period are removed. The previous newest series gets a
+        latency summary.
+        '''
+        self._timings.log_summary()
+        self._timings.clear_samples()
+        state = Series(ds.SeriesInstanceUID, ds.StudyInstanceUID)
+        with self._lock:
+            previous = self._series.pop(state.uid, None)
+            self._series[state.uid] = state
+            active = set(self._series)
+        if previous:
+            previous.close()
+        if not self._persist:
+            return state
+        if self._retention:
+            prune(self._motion_dir, self._retention * 86400, keep=active)
+        state.file = MotionFile.for_series(self._motion_dir, ds.StudyInstanceUID, ds.SeriesInstanceUID, fresh=not load)
+        num_loaded = 0
+        for instance,volreg in state.file.items():
+            state.motion.update(instance, volreg)
+            num_loaded += 1
+        logger.info(f'recording motion parameters for series {ds.SeriesInstanceUID} to {self._motion_dir}, loaded {num_loaded} existing volumes')
+        return state
+
+    def record(self, state, instance, volreg):
+        state.instances.set_volreg(instance, volreg)
+        state.motion.update(instance, volreg)
+        if state.file:
+            state.file.write(instance, volreg)
+        state.published.publish(freeze(instance, state.instances.path(instance), volreg))
+
     def listener(self, ds, path):
         key = int(ds.InstanceNumber)
-        self._instances[key] = {
-            'path': path,
-            'volreg': None
-        }
-        logger.debug('current state of instances')
-        logger.debug(json.dumps(self._instances, default=list, indent=2))
-
-        tasks = self.check_volreg(key)
-        logger.debug('publishing message to volreg topic with the following tasks')
-        logger.debug(json.dumps(tasks, indent=2))
-        pub.sendMessage('volreg', tasks=tasks)
+        if not is_valid(key):
+            logger.warning(f'ignoring {path}, InstanceNumber {key} is outside of 0 to {MAX_INSTANCE}')
+            return
+        state = self.series(ds.SeriesInstanceUID)
+        if state is None:
+            logger.info(f'tracking new series {ds.SeriesInstanceUID}')
+            state = self.open_series(ds)
+        state.subtitle = self.subtitle(ds)
+        state.instances.add(key, path)
+        # published before any task is queued, so a result can never be
+        # overwritten by this empty entry
+        state.published.publish(freeze(key, path))
+
+        tasks = self.check_volreg(state, key)
+        # serializing the table is O(n), only pay for it when it is logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'current state of instances\n{state.instances.dumps()}')
+            logger.debug(f'publishing message to volreg topic with the following tasks\n{dumps(tasks)}')
+        pub.sendMessage(topic('volreg', self._namespace), tasks=tasks)
         logger.debug(f'publishing message to params topic')
-        pub.sendMessage('params', ds=ds)
+        pub.sendMessage(topic('params', self._namespace), ds=ds)
+        self.plot(state)
+
+    def plot(self, state):
+        pub.sendMessage(
+            topic('plot', self._namespace),
+            instances=state.published,
+            motion=state.motion,
+            subtitle_string=state.subtitle,
+            series=state.uid
+        )
 
-        logger.debug(f'after volreg')
-        logger.debug(json.dumps(self._instances, indent=2))
+    def recover(self, ds, instances):
+        '''
+        Rebuild the state for a series that was already on disk when the
+        process started. instances is a list of (InstanceNumber, path) read
+        from the headers alone and ds is the header of the newest volume.
+        Motion parameters found in the motion file are reused, so only the
+        volumes without a result are registered again.
+        '''
+        start = time.perf_counter()
+        valid = [(key, path) for key,path in instances if is_valid(key)]
+        if len(valid) < len(instances):
+            logger.warning(f'ignoring {len(instances) - len(valid)} volumes of series {ds.SeriesInstanceUID} with an InstanceNumber outside of 0 to {MAX_INSTANCE}')
+        if not valid:
+            return
+        instances = valid
+        state = self.open_series(ds, load=True)
+        state.subtitle = self.subtitle(ds)
+        snapshot = state.motion.snapshot()
+        loaded = dict(zip(snapshot.N.tolist(), snapshot.params.tolist()))
+        for key,path in instances:
+            state.instances.add(key, path, loaded.get(key))
+        state.published.publish(*(freeze(key, path, loaded.get(key)) for key,path in instances))
+        tasks = self.check_recovered(state)
+        elapsed = time.perf_counter() - start
+        logger.info(f'recovered {len(state.instances)} volumes for series {ds.SeriesInstanceUID} in {elapsed * 1000:.1f} ms, {len(tasks)} left to register')
+        pub.sendMessage(topic('volreg', self._namespace), tasks=tasks)
+        pub.sendMessage(topic('params', self._namespace), ds=ds)
+        self.plot(state)
+
+    def check_recovered(self, state):
+        '''
+        Registration tasks for every recovered volume that has no result
+        '''
+        instances = state.instances
+        if self._reference == 'chain':
+            return [(entry, instances.left(entry.instance) or entry) for entry in instances.missing()]
+        base = self._base_index
+        if base is None:
+            base = instances.keys()[0]
+        if base not in instances:
+            logger.debug(f'waiting for base volume {base} before registering recovered volumes')
+            return list()
+        state.base = base
+        if instances.volreg(base) is None:
+            self.record(state, base, [0.0] * 6)
+        base = instances.entry(base)
+        return [(entry, base) for entry in instances.missing()]
+
+    def subtitle(self, ds):
         project = ds.get('StudyDescription', '[STUDY]')
         session = ds.get('PatientID', '[PATIENT]')
         scandesc = ds.get('SeriesDescription', '[SERIES]')
         scannum = ds.get('SeriesNumber', '[NUMBER]')
-        subtitle_string = f'{project} • {session} • {scandesc} • {scannum}'
-        pub.sendMessage('plot', instances=self._instances, subtitle_string=subtitle_string)
+        return f'{project} • {session} • {scandesc} • {scannum}'
+
+    def registered(self, series, instance, volreg):
+        '''
+        Called, possibly from a registration worker, whenever a volume's motion
+        parameters are written. VolReg already discards results superseded by
+        a newer task for the same volume.
+        '''
+        state = self.series(series)
+        if state is None or instance not in state.instances:
+            logger.debug(f'ignoring registration result for instance {instance} of series {series} that is no longer tracked')
+            return
+        self.record(state, instance, volreg)
+
+    def check_volreg(self, state, key):
+        if self._reference == 'fixed':
+            return self.check_volreg_fixed(state, key)
+        return self.check_volreg_chain(state, key)
+
+    def check_volreg_fixed(self, state, key):
+        '''
+        Register every volume once against a single base volume. The base is
+        the first volume to arrive, or the volume at the configured index.
+        Volumes that arrive before the base are registered when it shows up.
+        '''
+        instances = state.instances
+        current = instances.entry(key)
 
-    def check_volreg(self, key):
-        tasks = list()
-        current = self._instances[key]
+        if state.base is None and self._base_index in (None, key):
+            logger.debug(f'using {current.path} as the registration base')
+            state.base = key
 
-        # get numerical index of key O(log n)
-        i = self._instances.bisect_left(key)
+        if state.base is None:
+            logger.debug(f'waiting for base volume {self._base_index} before registering {current.path}')
+            return list()
 
-        # always register current node to left node
-        try:
-            left_index = max(0, i - 1)
-            left = self._instances.values()[left_index]
-            logger.debug(f'to the left of {current["path"]} is {left["path"]}')
-            tasks.append((current, left))
-        except IndexError:
-            pass
+        base = instances.entry(state.base)
+
+        if key != state.base:
+            return [(current, base)]
+
+        self.record(state, state.base, [0.0] * 6)
+        return [(entry, base) for entry in instances.missing()]
+
+    def check_volreg_chain(self, state, key):
+        instances = state.instances
+        current = instances.entry(key)
+
+        # always register current node to left node, the first node to itself
+        left = instances.left(key) or current
+        logger.debug(f'to the left of {current.path} is {left.path}')
+        tasks = [(current, left)]
 
         # if there is a right node, re-register to current node
-        try:
-            right_index = i + 1
-            right = self._instances.values()[right_index]
-            logger.debug(f'to the right of {current["path"]} is {right["path"]}')
+        right = instances.right(key)
+        if right:
+            logger.debug(f'to the right of {current.path} is {right.path}')
             tasks.append((right, current))
-        except IndexError:
-            pass
 
         return tasks
-
@@ -0,0 +1,152 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class VolumeCache:
+    '''
+    Bounded least-recently-used cache of decoded volumes, keyed by
+    (dicom path, InstanceNumber). When an entry is evicted it is handed
+    to on_evict so that any files backing it can be removed. Entries that
+    a registration worker is still using are pinned and only evicted
+    once every pin is released.
+    '''
+    def __init__(self, maxsize=8, on_evict=None):
+        self._maxsize = max(1, int(maxsize))
+        self._on_evict = on_evict
+        self._entries = OrderedDict()
+        self._pins = dict()
+        self._cleared = set()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, pins=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.pin(key, pins)
+            return value
+
+    def get_or_load(self, key, load, pins=None):
+        '''
+        Return the cached value for key, calling load() on a miss. Concurrent
+        callers asking for the same key wait for a single load instead of
+        decoding the same volume twice. With pins, the entry is pinned and
+        its key appended to pins, so it stays until unpin(*pins).
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.pin(key, pins)
+                return self._entries[key]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = threading.Event()
+                self.misses += 1
+        if not owner:
+            pending.wait()
+            value = self.get(key, pins)
+            if value is not None:
+                return value
+            value = load()
+            self.put(key, value, pins)
+            return value
+        try:
+            value = load()
+            self.put(key, value, pins)
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    def put(self, key, value, pins=None):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._cleared.discard(key)
+            self.pin(key, pins)
+            evicted = self.shrink()
+        for old_value in evicted:
+            self.evict(old_value)
+
+    def pin(self, key, pins):
+        '''
+        Called with the lock held
+        '''
+        if pins is None:
+            return
+        self._pins[key] = self._pins.get(key, 0) + 1
+        pins.append(key)
+
+    def unpin(self, *keys):
+        evicted = list()
+        with self._lock:
+            for key in keys:
+                count = self._pins.get(key, 0) - 1
+                if count > 0:
+                    self._pins[key] = count
+                    continue
+                self._pins.pop(key, None)
+                if key in self._cleared:
+                    self._cleared.discard(key)
+                    if key in self._entries:
+                        evicted.append(self._entries.pop(key))
+            evicted.extend(self.shrink())
+        for value in evicted:
+            self.evict(value)
+
+    def shrink(self):
+        '''
+        Remove least recently used entries that are not pinned until the cache
+        fits, called with the lock held. The most recent entry, which its caller
+        is about to use, is always kept, and pinned entries can keep the cache
+        over its size until they are released.
+        '''
+        evicted = list()
+        for key in list(self._entries)[:-1]:
+            if len(self._entries) <= self._maxsize:
+                break
+            if key in self._pins:
+                continue
+            logger.debug(f'evicting {key} from volume cache')
+            evicted.append(self._entries.pop(key))
+        return evicted
+
+    def clear(self):
+        '''
+        Evict every entry, entries that are pinned are evicted when released
+        '''
+        evicted = list()
+        with self._lock:
+            for key in list(self._entries):
+                if key in self._pins:
+                    self._cleared.add(key)
+                else:
+                    evicted.append(self._entries.pop(key))
+            self.hits = 0
+            self.misses = 0
+        for value in evicted:
+            self.evict(value)
+
+    def evict(self, value):
+        if self._on_evict:
+            self._on_evict(value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,247 @@
+import json
+import logging
+import threading
+import numpy as np
+from collections import namedtuple
+from sortedcontainers import SortedList
+from scanbuddy.proc.motion import COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# entries per chunk, publishing a change copies the chunks it touches and the
+# (short) tuple of chunks, never the other entries
+CHUNK = 64
+
+# instances are rows of arrays indexed by InstanceNumber, this bounds their
+# size (about 6 MB per table) while leaving room for days of fMRI at any TR
+MAX_INSTANCE = 100000
+
+Instance = namedtuple('Instance', [
+    'instance',
+    'path',
+    'volreg'
+])
+
+def freeze(instance, path, volreg=None):
+    '''
+    An immutable entry, volreg becomes a tuple of floats
+    '''
+    if volreg is not None:
+        volreg = tuple(float(x) for x in volreg)
+    return Instance(instance, path, volreg)
+
+class InstancesSnapshot:
+    '''
+    One immutable version of the instances of a series, indexed by
+    InstanceNumber and iterated in InstanceNumber order. Entries are kept in
+    fixed size chunks, so a new version shares every unchanged chunk with the
+    version it was made from.
+    '''
+    __slots__ = ('series', 'version', '_chunks', '_len')
+
+    def __init__(self, series=None, version=0, chunks=(), length=0):
+        self.series = series
+        self.version = version
+        self._chunks = chunks
+        self._len = length
+
+    def get(self, instance, default=None):
+        i,offset = divmod(instance, CHUNK)
+        if 0 <= i < len(self._chunks) and self._chunks[i]:
+            entry = self._chunks[i][offset]
+            if entry is not None:
+                return entry
+        return default
+
+    def __getitem__(self, instance):
+        entry = self.get(instance)
+        if entry is None:
+            raise KeyError(instance)
+        return entry
+
+    def __contains__(self, instance):
+        return self.get(instance) is not None
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        return (entry.instance for entry in self.values())
+
+    def values(self):
+        for chunk in self._chunks:
+            if chunk:
+                yield from (entry for entry in chunk if entry is not None)
+
+    def items(self):
+        return ((entry.instance, entry) for entry in self.values())
+
+    def replace(self, entries):
+        '''
+        A new version with every Instance in entries inserted or replaced
+        '''
+        chunks = list(self._chunks)
+        length = self._len
+        copied = dict()
+        for entry in entries:
+            i,offset = divmod(entry.instance, CHUNK)
+            if i >= len(chunks):
+                chunks.extend([None] * (i + 1 - len(chunks)))
+            chunk = copied.get(i)
+            if chunk is None:
+                chunk = copied[i] = list(chunks[i] or (None,) * CHUNK)
+            if chunk[offset] is None:
+                length += 1
+            chunk[offset] = entry
+        for i,chunk in copied.items():
+            chunks[i] = tuple(chunk)
+        return InstancesSnapshot(self.series, self.version + 1, tuple(chunks), length)
+
+class Instances:
+    '''
+    The published instances of one series. Writers swap in a new snapshot
+    under a lock, readers take the current one with a single attribute read
+    and never lock or copy.
+    '''
+    def __init__(self, series=None):
+        self._lock = threading.Lock()
+        self._snapshot = InstancesSnapshot(series)
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def snapshot(self):
+        return self._snapshot
+
+    def publish(self, *entries):
+        with self._lock:
+            self._snapshot = self._snapshot.replace(entries)
+            return self._snapshot
+
+class Entry:
+    '''
+    One volume of a registration task, (moving, base) pairs of these are
+    what the Processor hands to VolReg
+    '''
+    __slots__ = ('series', 'instance', 'path')
+
+    def __init__(self, series, instance, path):
+        self.series = series
+        self.instance = instance
+        self.path = path
+
+    def todict(self):
+        return {
+            'series': self.series,
+            'instance': self.instance,
+            'path': self.path
+        }
+
+def is_valid(instance):
+    '''
+    True if an InstanceNumber can be used as a row of an InstanceTable
+    '''
+    return 0 <= instance <= MAX_INSTANCE
+
+def dumps(tasks):
+    '''
+    Registration tasks as JSON, for debug logging
+    '''
+    return json.dumps([[entry.todict() for entry in task] for task in tasks], indent=2)
+
+class InstanceTable:
+    '''
+    The working instances of one series: a sorted index of InstanceNumbers
+    and arrays indexed by InstanceNumber with the path and the motion
+    parameters (NaN until registered) of every volume, so there is no
+    Python object per volume. Writers (the Processor and registration
+    workers recording results) are serialized by a lock.
+    '''
+    def __init__(self, series=None, capacity=1024):
+        self.series = series
+        self._lock = threading.Lock()
+        self._keys = SortedList()
+        self._paths = np.full(capacity, None, dtype=object)
+        self._params = np.full((capacity, len(COLUMNS)), np.nan)
+
+    def grow(self, size):
+        capacity = max(size, 2 * len(self._paths))
+        logger.debug(f'growing instance table to {capacity} rows')
+        paths = np.full(capacity, None, dtype=object)
+        paths[:len(self._paths)] = self._paths
+        params = np.full((capacity, len(COLUMNS)), np.nan)
+        params[:len(self._params)] = self._params
+        self._paths,self._params = paths,params
+
+    def add(self, instance, path, volreg=None):
+        '''
+        Insert or replace an instance, a replaced instance loses its motion
+        parameters unless new ones are given
+        '''
+        if not is_valid(instance):
+            raise ValueError(f'InstanceNumber {instance} is outside of 0 to {MAX_INSTANCE}')
+        with self._lock:
+            if instance >= len(self._paths):
+                self.grow(instance + 1)
+            if self._paths[instance] is None:
+                self._keys.add(instance)
+            self._paths[instance] = path
+            self._params[instance] = np.nan if volreg is None else volreg
+        return Entry(self.series, instance, path)
+
+    def set_volreg(self, instance, volreg):
+        with self._lock:
+            self._params[instance] = volreg
+
+    def __contains__(self, instance):
+        return 0 <= instance < len(self._paths) and self._paths[instance] is not None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return self._keys
+
+    def entry(self, instance):
+        return Entry(self.series, instance, self._paths[instance])
+
+    def path(self, instance):
+        return self._paths[instance]
+
+    def volreg(self, instance):
+        row = self._params[instance]
+        return None if np.isnan(row[0]) else row.tolist()
+
+    def left(self, instance):
+        '''
+        The entry with the next lower InstanceNumber, None if there is none
+        '''
+        i = self._keys.bisect_left(instance)
+        return self.entry(self._keys[i - 1]) if i > 0 else None
+
+    def right(self, instance):
+        '''
+        The entry with the next higher InstanceNumber, None if there is none
+        '''
+        i = self._keys.bisect_right(instance)
+        return self.entry(self._keys[i]) if i < len(self._keys) else None
+
+    def missing(self):
+        '''
+        Entries without motion parameters, in InstanceNumber order
+        '''
+        keys = np.fromiter(self._keys, dtype=int, count=len(self._keys))
+        return [self.entry(int(key)) for key in keys[np.isnan(self._params[keys, 0])]]
+
+    def dumps(self):
+        '''
+        The table as JSON, for debug logging
+        '''
+        return json.dumps({
+            int(key): {'path': self.path(key), 'volreg': self.volreg(key)}
+            for key in self._keys
+        }, indent=2)
@@ -0,0 +1,152 @@
+import logging
+import itertools
+import threading
+import numpy as np
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# same order as the volreg arrays, [roll, pitch, yaw, dS, dL, dP]
+COLUMNS = ['roll', 'pitch', 'yaw', 'x', 'y', 'z']
+TRANSLATIONS = slice(3, 6)
+
+series_ids = itertools.count(1)
+
+Snapshot = namedtuple('Snapshot', [
+    'series',
+    'version',
+    'rewrites',
+    'num_vols',
+    'exceedances',
+    'max_abs_motion',
+    'N',
+    'params'
+])
+
+class MotionStore:
+    '''
+    Motion parameters for one series in a preallocated array indexed by
+    InstanceNumber. The number of volumes, the number of volumes whose
+    translations exceed each threshold and the maximum absolute translation
+    are kept up to date as results arrive, so reading them is O(1).
+
+    rewrites counts updates that did not simply append a row after every
+    existing row (a replaced estimate or an out of order arrival). While it
+    is unchanged, readers can fetch only the rows past what they have seen.
+
+    Appended rows are also copied to compact N and params arrays as they
+    arrive, and snapshot() returns read-only views of them, cached per
+    version, so a snapshot costs the same at any series length. Only a
+    rewrite makes the next snapshot rebuild them from the full array.
+    '''
+    def __init__(self, capacity=1024, thresholds=(0.5, 1.0)):
+        self.id = next(series_ids)
+        self._lock = threading.Lock()
+        self._thresholds = np.array(thresholds, dtype=float)
+        self._params = np.full((capacity, len(COLUMNS)), np.nan)
+        self._end = 0
+        self._num_vols = 0
+        self._exceedances = np.zeros(len(thresholds), dtype=int)
+        self._max_abs_motion = 0.0
+        self._version = 0
+        self._rewrites = 0
+        self._N = np.empty(capacity, dtype=int)
+        self._rows = np.empty((capacity, len(COLUMNS)))
+        # rows in _N and _rows, None when a rewrite made them stale
+        self._count = 0
+        self._snapshot = None
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def num_vols(self):
+        return self._num_vols
+
+    def update(self, instance, volreg):
+        '''
+        Insert or replace the motion parameters for an instance
+        '''
+        with self._lock:
+            if instance >= len(self._params):
+                self.grow(instance + 1)
+            row = self._params[instance]
+            rescan = False
+            if instance < self._end:
+                self._rewrites += 1
+                self._count = None
+            if np.isnan(row[0]):
+                self._num_vols += 1
+            else:
+                # take the old estimate out of the running counts
+                old = np.abs(row[TRANSLATIONS]).max()
+                self._exceedances -= old > self._thresholds
+                rescan = old >= self._max_abs_motion
+            row[:] = volreg
+            if self._count is not None:
+                self.append(instance, row)
+            new = np.abs(row[TRANSLATIONS]).max()
+            self._exceedances += new > self._thresholds
+            self._max_abs_motion = max(self._max_abs_motion, new)
+            self._end = max(self._end, instance + 1)
+            if rescan:
+                translations = np.abs(self._params[:self._end, TRANSLATIONS])
+                self._max_abs_motion = float(np.nanmax(translations, initial=0.0))
+            self._version += 1
+
+    def grow(self, size):
+        capacity = max(size, 2 * len(self._params))
+        logger.debug(f'growing motion store to {capacity} rows')
+        params = np.full((capacity, len(COLUMNS)), np.nan)
+        params[:len(self._params)] = self._params
+        self._params = params
+
+    def append(self, instance, row):
+        if self._count == len(self._N):
+            self._N,self._rows = self.compact(self._N[:self._count], self._rows[:self._count])
+        self._N[self._count] = instance
+        self._rows[self._count] = row
+        self._count += 1
+
+    def compact(self, N, rows):
+        '''
+        New compact arrays holding N and rows with room to append as many
+        again. Snapshots keep views of the old arrays, which never change.
+        '''
+        capacity = max(2 * len(N), 64)
+        compact_N = np.empty(capacity, dtype=int)
+        compact_rows = np.empty((capacity, len(COLUMNS)))
+        compact_N[:len(N)] = N
+        compact_rows[:len(N)] = rows
+        return compact_N,compact_rows
+
+    def snapshot(self):
+        '''
+        A consistent, read-only view of the counters and of every row that
+        has a result
+        '''
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.version == self._version:
+                return self._snapshot
+            if self._count is None:
+                params = self._params[:self._end]
+                valid = ~np.isnan(params[:, 0])
+                N = np.nonzero(valid)[0]
+                self._N,self._rows = self.compact(N, params[valid])
+                self._count = len(N)
+            N = self._N[:self._count]
+            params = self._rows[:self._count]
+            N.flags.writeable = False
+            params.flags.writeable = False
+            self._snapshot = Snapshot(
+                series=self.id,
+                version=self._version,
+                rewrites=self._rewrites,
+                num_vols=self._num_vols,
+                exceedances=tuple(int(x) for x in self._exceedances),
+                max_abs_motion=float(self._max_abs_motion),
+                N=N,
+                params=params
+            )
+            return self._snapshot
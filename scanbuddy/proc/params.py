@@ -1,22 +1,31 @@
 import os
 import logging
-from pubsub import pub
+from scanbuddy.bus import bus
+from scanbuddy.topics import topic
 
 logger = logging.getLogger(__name__)
 
 class Params:
-    def __init__(self, config, broker=None):
+    def __init__(self, config, broker=None, namespace=None):
         self._config = config.find_one('$.params', dict())
         self._broker = broker
-        self._checked = False
-        pub.subscribe(self.listener, 'params')
-        pub.subscribe(self.reset, 'reset')
+        self._namespace = namespace
+        self._checked = set()
+        self._stage = bus.stage('params', namespace)
+        # every volume of a series carries the same parameters, so one
+        # that does not fit in the queue is simply checked with a later one
+        self._stage.subscribe(self.listener, 'params', policy='drop')
+        self._stage.subscribe(self.reset, 'reset')
+        self._stage.subscribe(self.evict, 'evict')
 
     def reset(self):
-        self._checked = False
+        self._checked.clear()
+
+    def evict(self, series):
+        self._checked.discard(series)
 
     def listener(self, ds):
-        if self._checked:
+        if ds.SeriesInstanceUID in self._checked:
             logger.info(f'already checked an instance from series {ds.SeriesNumber}')
             return
         for item in self._config:
@@ -25,7 +34,7 @@ class Params:
             f(ds, args)
 
     def coil_elements(self, ds, args):
-        self._checked = True
+        self._checked.add(ds.SeriesInstanceUID)
         patient_name = ds.get('PatientName', 'UNKNOWN PATIENT')
         series_number = ds.get('SeriesNumber', 'UNKNOWN SERIES')
         receive_coil = self.findcoil(ds)
@@ -43,7 +52,7 @@ class Params:
             if a == b:
                 logger.warning(message)
                 logger.info(f'publishing message to message broker')
-                self._broker.publish('scanbuddy_messages', message)
+                self._broker.publish(topic('scanbuddy_messages', self._namespace), message)
                 break
 
     def findcoil(self, ds):
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import struct
+import logging
+import threading
+import numpy as np
+from pathlib import Path
+from scanbuddy.proc.motion import COLUMNS
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SBMOTION'
+VERSION = 1
+# magic, format version and json header length, followed by the json header
+HEADER_SIZE = 512
+PREFIX = struct.Struct('<8sII')
+ROW_SIZE = len(COLUMNS) * 4
+
+class MotionFile:
+    '''
+    Motion parameters for one series on disk: a fixed size header holding the
+    study and series UIDs followed by a memory-mapped float32 array with one
+    row per InstanceNumber. Rows that have no result yet are NaN. The file
+    doubles in size whenever an instance falls past the end.
+    '''
+    def __init__(self, path, study, series, capacity=1024):
+        self._path = Path(path)
+        self._lock = threading.Lock()
+        self.header = {
+            'study': study,
+            'series': series,
+            'columns': COLUMNS
+        }
+        if self._path.exists():
+            header,rows = read_header(self._path)
+            if header['series'] != series:
+                raise ValueError(f'{self._path} belongs to series {header["series"]}, not {series}')
+            self.header = header
+            capacity = rows
+        else:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self._path, 'wb') as fo:
+                fo.write(encode_header(self.header))
+            self.resize(capacity)
+        self._rows = self.map(capacity)
+
+    @classmethod
+    def for_series(cls, directory, study, series, fresh=False):
+        '''
+        The motion file of a series, with fresh any rows left by an earlier
+        run are discarded
+        '''
+        path = Path(directory, f'{series}.motion')
+        if fresh:
+            path.unlink(missing_ok=True)
+        return cls(path, study, series)
+
+    def map(self, capacity):
+        return np.memmap(
+            self._path,
+            dtype=np.float32,
+            mode='r+',
+            offset=HEADER_SIZE,
+            shape=(capacity, len(COLUMNS))
+        )
+
+    def resize(self, capacity):
+        # new rows are filled with nan rather than left as zeros
+        rows = (os.path.getsize(self._path) - HEADER_SIZE) // ROW_SIZE
+        with open(self._path, 'r+b') as fo:
+            fo.seek(HEADER_SIZE + rows * ROW_SIZE)
+            fo.write(np.full((capacity - rows, len(COLUMNS)), np.nan, dtype=np.float32).tobytes())
+
+    def write(self, instance, volreg):
+        with self._lock:
+            if self._rows is None:
+                logger.debug(f'{self._path} is closed, not writing instance {instance}')
+                return
+            if instance >= len(self._rows):
+                self._rows.flush()
+                capacity = max(instance + 1, 2 * len(self._rows))
+                logger.debug(f'growing {self._path} to {capacity} rows')
+                del self._rows
+                self.resize(capacity)
+                self._rows = self.map(capacity)
+            self._rows[instance] = volreg
+
+    def items(self):
+        '''
+        (InstanceNumber, parameters) for every row that has a result
+        '''
+        with self._lock:
+            rows = np.array(self._rows, dtype=np.float64)
+        for instance in np.nonzero(~np.isnan(rows[:, 0]))[0]:
+            yield int(instance), rows[instance].tolist()
+
+    def close(self):
+        with self._lock:
+            if self._rows is not None:
+                self._rows.flush()
+                self._rows = None
+
+def prune(directory, max_age, keep=()):
+    '''
+    Remove the motion files in directory that were last written more than
+    max_age seconds ago, except those of the series in keep
+    '''
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in Path(directory).glob('*.motion'):
+        try:
+            if path.stem in keep or path.stat().st_mtime > cutoff:
+                continue
+            path.unlink()
+            removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info(f'removed {removed} motion files older than {max_age / 86400:g} days from {directory}')
+    return removed
+
+def encode_header(header):
+    data = json.dumps(header).encode()
+    if PREFIX.size + len(data) > HEADER_SIZE:
+        raise ValueError('motion file header is too large')
+    return (PREFIX.pack(MAGIC, VERSION, len(data)) + data).ljust(HEADER_SIZE, b'\0')
+
+def read_header(path):
+    '''
+    Return the json header and the number of rows in a motion file
+    '''
+    with open(path, 'rb') as fo:
+        magic,version,length = PREFIX.unpack(fo.read(PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a motion file')
+        header = json.loads(fo.read(length))
+    rows = (os.path.getsize(path) - HEADER_SIZE) // ROW_SIZE
+    return header, rows
+
+def load(path):
+    '''
+    Read a motion file without registering anything. Returns the header and
+    a float64 array with one row per InstanceNumber.
+    '''
+    header,rows = read_header(path)
+    data = np.fromfile(path, dtype=np.float32, offset=HEADER_SIZE, count=rows * len(COLUMNS))
+    return header, data.reshape(rows, len(COLUMNS)).astype(np.float64)
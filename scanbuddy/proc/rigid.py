@@ -0,0 +1,224 @@
+import math
+import logging
+import pydicom
+import numpy as np
+from scanbuddy.config import ConfigError
+
+logger = logging.getLogger(__name__)
+
+class Volume:
+    '''
+    A decoded volume and the affine that maps array indices (slice, row, column)
+    to patient coordinates in millimeters (DICOM LPS).
+    '''
+    def __init__(self, data, affine):
+        self.data = data
+        self.affine = affine
+
+    @classmethod
+    def from_dicom(cls, path):
+        ds = pydicom.dcmread(path, force=True)
+        return cls.from_dataset(ds)
+
+    @classmethod
+    def from_dataset(cls, ds):
+        data = ds.pixel_array.astype(np.float32)
+        if data.ndim == 2:
+            # a classic image holds one slice, or a whole volume as a Siemens
+            # mosaic that only the CSA header can unpack
+            raise ConfigError(f'the rigid volreg backend needs multi-frame volumes, {ds.get("SOPInstanceUID", "this file")} is a single 2D image (e.g., a mosaic), use volreg.backend: afni')
+        return cls(data, geometry(ds, data.shape[0]))
+
+    def center(self):
+        ijk = (np.array(self.data.shape) - 1) / 2.0
+        return self.affine[:3, :3] @ ijk + self.affine[:3, 3]
+
+def geometry(ds, nslices):
+    orientation = functional(ds, 'PlaneOrientationSequence', 'ImageOrientationPatient')
+    measures = functional(ds, 'PixelMeasuresSequence')
+    if measures is None:
+        measures = ds
+    spacing = [float(x) for x in measures.PixelSpacing]
+    row = np.array(orientation[:3], dtype=float)
+    col = np.array(orientation[3:], dtype=float)
+    first, last = positions(ds)
+    if last is not None and nslices > 1:
+        slc = (last - first) / (nslices - 1)
+    else:
+        thickness = measures.get('SpacingBetweenSlices', None) or measures.get('SliceThickness', 1.0)
+        slc = np.cross(row, col) * float(thickness)
+    affine = np.eye(4)
+    affine[:3, 0] = slc
+    affine[:3, 1] = col * spacing[0]
+    affine[:3, 2] = row * spacing[1]
+    affine[:3, 3] = first
+    return affine
+
+def functional(ds, sequence, attribute=None):
+    '''
+    Find a functional group macro in the shared functional groups, falling back
+    to the first per-frame item, then to the top level dataset for classic images
+    '''
+    for groups in ('SharedFunctionalGroupsSequence', 'PerFrameFunctionalGroupsSequence'):
+        if groups in ds and sequence in ds[groups][0]:
+            item = ds[groups][0][sequence][0]
+            return item.get(attribute) if attribute else item
+    if attribute:
+        return ds.get(attribute)
+    return None
+
+def positions(ds):
+    if 'PerFrameFunctionalGroupsSequence' in ds:
+        frames = ds.PerFrameFunctionalGroupsSequence
+        first = frames[0].PlanePositionSequence[0].ImagePositionPatient
+        last = frames[-1].PlanePositionSequence[0].ImagePositionPatient
+        return np.array(first, dtype=float), np.array(last, dtype=float)
+    return np.array(ds.ImagePositionPatient, dtype=float), None
+
+def matrix(params, center):
+    '''
+    Build the 4x4 transform for [roll, pitch, yaw, dS, dL, dP] rotating about center.
+    roll, pitch and yaw are counterclockwise rotations in degrees about the I-S, R-L
+    and A-P axes. Translations are in millimeters.
+    '''
+    roll, pitch, yaw = np.radians(params[:3])
+    dS, dL, dP = params[3:]
+    cr, sr = math.cos(roll), math.sin(roll)
+    cp, sp = math.cos(pitch), math.sin(pitch)
+    cy, sy = math.cos(yaw), math.sin(yaw)
+    rz = np.array([[cr, -sr, 0], [sr, cr, 0], [0, 0, 1]])
+    rx = np.array([[1, 0, 0], [0, cp, -sp], [0, sp, cp]])
+    ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rot = rz @ rx @ ry
+    T = np.eye(4)
+    T[:3, :3] = rot
+    T[:3, 3] = np.array([dL, dP, dS]) + center - rot @ center
+    return T
+
+def parameters(T, center):
+    rot = T[:3, :3]
+    dL, dP, dS = T[:3, 3] - center + rot @ center
+    pitch = math.asin(max(-1.0, min(1.0, rot[2, 1])))
+    yaw = math.atan2(-rot[2, 0], rot[2, 2])
+    roll = math.atan2(-rot[0, 1], rot[1, 1])
+    return [
+        math.degrees(roll),
+        math.degrees(pitch),
+        math.degrees(yaw),
+        float(dS),
+        float(dL),
+        float(dP)
+    ]
+
+def sample(data, coords):
+    '''
+    Trilinear interpolation of data at fractional array indices coords (3 x N).
+    Returns the sampled values and a mask of the points that fell inside the grid.
+    '''
+    shape = np.array(data.shape)[:, np.newaxis]
+    valid = np.all((coords >= 0) & (coords <= shape - 1), axis=0)
+    coords = np.clip(coords, 0, shape - 1)
+    lo = np.minimum(np.floor(coords).astype(np.intp), shape - 2)
+    frac = coords - lo
+    s0 = data.shape[1] * data.shape[2]
+    s1 = data.shape[2]
+    flat = data.ravel()
+    index = lo[0] * s0 + lo[1] * s1 + lo[2]
+    out = np.zeros(coords.shape[1], dtype=np.float64)
+    for d0 in (0, 1):
+        w0 = frac[0] if d0 else 1 - frac[0]
+        for d1 in (0, 1):
+            w1 = frac[1] if d1 else 1 - frac[1]
+            for d2 in (0, 1):
+                w2 = frac[2] if d2 else 1 - frac[2]
+                out += w0 * w1 * w2 * flat[index + d0 * s0 + d1 * s1 + d2]
+    return out, valid
+
+def smooth(data):
+    '''
+    Separable [1, 2, 1] / 4 binomial filter along every axis
+    '''
+    out = data
+    for axis in range(out.ndim):
+        if out.shape[axis] < 3:
+            continue
+        padded = np.concatenate([
+            np.take(out, [0], axis=axis),
+            out,
+            np.take(out, [-1], axis=axis)
+        ], axis=axis)
+        n = out.shape[axis]
+        lo = np.take(padded, range(0, n), axis=axis)
+        mid = np.take(padded, range(1, n + 1), axis=axis)
+        hi = np.take(padded, range(2, n + 2), axis=axis)
+        out = (lo + 2 * mid + hi) / 4.0
+    return out
+
+class Rigid:
+    '''
+    Six parameter rigid-body registration using inverse compositional Gauss-Newton
+    on the sum of squared intensity differences, with trilinear interpolation (the
+    same model as 3dvolreg -linear). The Jacobian is computed once from the base.
+    '''
+    def __init__(self, max_iter=20, tolerance=0.001, stride=1, clip=0.1, smooth=True):
+        self._max_iter = max_iter
+        self._tolerance = tolerance
+        self._stride = max(1, int(stride))
+        self._clip = clip
+        self._smooth = smooth
+
+    def prepare(self, base):
+        data = smooth(base.data) if self._smooth else base.data
+        interior = np.zeros(data.shape, dtype=bool)
+        interior[tuple(slice(1, -1) if n > 2 else slice(None) for n in data.shape)] = True
+        threshold = self._clip * np.percentile(data, 98)
+        mask = interior & (data > threshold)
+        ijk = np.array(np.nonzero(mask))[:, ::self._stride]
+        values = data[tuple(ijk)].astype(np.float64)
+        a = base.affine[:3, :3]
+        x = a @ ijk + base.affine[:3, 3][:, np.newaxis]
+        grads = np.array([g[tuple(ijk)] for g in np.gradient(data)])
+        grads = np.linalg.inv(a).T @ grads
+        center = base.center()
+        d = x - center[:, np.newaxis]
+        gx, gy, gz = grads
+        rad = math.pi / 180
+        jacobian = np.stack([
+            rad * (-gx * d[1] + gy * d[0]),
+            rad * (-gy * d[2] + gz * d[1]),
+            rad * (gx * d[2] - gz * d[0]),
+            gz,
+            gx,
+            gy
+        ], axis=1)
+        return {
+            'points': np.vstack([x, np.ones(x.shape[1])]),
+            'values': values,
+            'jacobian': jacobian,
+            'center': center
+        }
+
+    def register(self, base, moving, prepared=None):
+        if prepared is None:
+            prepared = self.prepare(base)
+        data = smooth(moving.data) if self._smooth else moving.data
+        inverse = np.linalg.inv(moving.affine)
+        points = prepared['points']
+        jacobian = prepared['jacobian']
+        center = prepared['center']
+        T = np.eye(4)
+        for i in range(self._max_iter):
+            coords = (inverse @ T @ points)[:3]
+            values, valid = sample(data, coords)
+            residual = values[valid] - prepared['values'][valid]
+            J = jacobian[valid]
+            try:
+                delta = np.linalg.solve(J.T @ J, J.T @ residual)
+            except np.linalg.LinAlgError:
+                logger.warning('registration is singular, returning current estimate')
+                break
+            T = T @ np.linalg.inv(matrix(delta, center))
+            if np.max(np.abs(delta)) < self._tolerance:
+                break
+        logger.debug(f'registration converged after {i + 1} iterations')
+        return parameters(T, center)
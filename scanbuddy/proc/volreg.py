@@ -1,105 +1,311 @@
 import os
-import glob
-import json
+import shutil
 import logging
 import random
-import pydicom
+import tempfile
+import threading
 import subprocess
 import numpy as np
 from pubsub import pub
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scanbuddy.config import ConfigError
+from scanbuddy.bus import bus
+from scanbuddy.topics import topic
+from scanbuddy.timing import for_namespace
+from scanbuddy.proc.rigid import Rigid, Volume
+from scanbuddy.proc.cache import VolumeCache
+from scanbuddy.proc.instances import dumps
 
 logger = logging.getLogger(__name__)
 
+BACKENDS = ('afni', 'rigid')
+
+# evicted series remembered so their queued tasks are skipped
+MAX_EVICTED = 64
+
+def make_pool(workers):
+    '''
+    Registration worker pool, or None to run registration synchronously
+    '''
+    if workers <= 0:
+        return None
+    logger.info(f'starting volume registration pool with {workers} workers')
+    return ThreadPoolExecutor(
+        max_workers=workers,
+        thread_name_prefix='volreg'
+    )
+
 class VolReg:
-    def __init__(self, mock=False):
+    def __init__(self, config=None, mock=False, namespace=None, pool=None):
         self._mock = mock
-        pub.subscribe(self.listener, 'volreg')
+        self._namespace = namespace
+        self._timings = for_namespace(namespace)
+        self._backend = 'afni'
+        if config:
+            self._backend = config.find_one('$.volreg.backend', default='afni')
+        if self._backend not in BACKENDS:
+            raise ConfigError(f'unknown volreg backend "{self._backend}", expected one of {BACKENDS}')
+        if self._backend == 'rigid':
+            self._rigid = Rigid(
+                max_iter=config.find_one('$.volreg.rigid.max_iter', default=20),
+                tolerance=config.find_one('$.volreg.rigid.tolerance', default=0.001),
+                stride=config.find_one('$.volreg.rigid.stride', default=1)
+            )
+        cache_size = config.find_one('$.volreg.cache.size', default=8) if config else 8
+        self._cache = VolumeCache(
+            maxsize=cache_size,
+            on_evict=self.evict
+        )
+        self.init_pool(config, pool)
+        logger.info(f'using {self._backend} volume registration backend')
+        self._stage = bus.stage('volreg', namespace)
+        self._stage.subscribe(self.listener, 'volreg')
+        self._stage.subscribe(self.reset, 'reset')
+        self._stage.subscribe(self.forget, 'evict')
+
+    def init_pool(self, config, pool=None):
+        '''
+        Registration runs on a pool of worker threads so that the watcher thread
+        is never blocked. Both backends spend their time in subprocesses or NumPy,
+        which release the GIL. Setting workers to 0 runs tasks synchronously.
+        A pool can be passed in to share it between several scanners, each
+        still with its own queue limit.
+        '''
+        workers = config.find_one('$.volreg.workers', default=1) if config else 1
+        queue_size = config.find_one('$.volreg.queue', default=32) if config else 32
+        self._pool = pool
+        self._slots = threading.BoundedSemaphore(max(1, queue_size))
+        self._lock = threading.Lock()
+        self._latest = dict()
+        self._evicted = OrderedDict()
+        self._pending = list()
+        self._sequence = 0
+        if not pool:
+            self._pool = make_pool(workers)
+
+    def reset(self):
+        with self._lock:
+            self._latest.clear()
+            self._evicted.clear()
+        self._cache.clear()
+
+    def forget(self, series):
+        '''
+        Skip queued tasks of a series the watcher is no longer tracking, its
+        files may already be gone
+        '''
+        with self._lock:
+            self._evicted[series] = True
+            if len(self._evicted) > MAX_EVICTED:
+                self._evicted.popitem(last=False)
 
     def listener(self, tasks):
         '''
-        In the following example, there are two tasks (most of the time there will be only 1)
-             - dicom.2.dcm should be registered to dicom.1.dcm and the 6 moco params should be put into the 'volreg' attribute for dicom.2.dcm
-             - dicom.3.dcm should be registered to dicom.2.dcm and the 6 moco params should be put into the 'volreg' attribute for dicom.3.dcm
+        Each task is a (moving, base) pair of instance Entry. In the following
+        example, there are two tasks (most of the time there will be only 1)
+             - dicom.2.dcm should be registered to dicom.1.dcm and the 6 moco params published for dicom.2.dcm
+             - dicom.3.dcm should be registered to dicom.2.dcm and the 6 moco params published for dicom.3.dcm
         '''
-        logger.info('received tasks for volume registration')
-        logger.info(json.dumps(tasks, indent=2))
-        self.tasks = tasks
-        if not self.tasks:
-            return 
+        logger.info(f'received {len(tasks)} tasks for volume registration')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(dumps(tasks))
+        if not tasks:
+            return
 
         if self._mock:
-            for task in self.tasks:
-                task[0]['volreg'] = self.mock()
+            for task in tasks:
+                self._timings.stamp(task[0].series, task[0].instance, 'registered')
+                pub.sendMessage(topic('registered', self._namespace), series=task[0].series, instance=task[0].instance, volreg=self.mock())
             return
 
-        self.run()
-
-    def run(self):
-        self.get_num_tasks()
+        self.submit(tasks)
 
-        #### iterate through each task, create a nii file, run 3dvolreg and insert array into task volreg key-value pair
-        for task_idx in range(self.num_tasks):
-            self.check_dicoms(task_idx)
+    def submit(self, tasks):
+        '''
+        Queue tasks for the worker pool. A moving volume can be queued more than
+        once (e.g., when a volume arrives out of order in chain mode or a file
+        is sent again), so only the result of the most recent submission is
+        kept. Tasks that pile up while the workers are busy (e.g., a burst of
+        files after the share stalls) are drained together as one batch. When
+        the queue is full this blocks until a batch finishes.
+        '''
+        batch = list()
+        with self._lock:
+            for task in tasks:
+                self._sequence += 1
+                self._latest[(task[0].series, task[0].instance)] = self._sequence
+                batch.append((task, self._sequence))
+        if not self._pool:
+            self.run(batch)
+            return
+        for entry in batch:
+            self._slots.acquire()
+            with self._lock:
+                self._pending.append(entry)
+                # a drain is already waiting for a worker and will pick this up
+                if len(self._pending) > 1:
+                    continue
+            self._pool.submit(self.drain)
+
+    def drain(self):
+        with self._lock:
+            batch,self._pending = self._pending,list()
+        start = time.time()
+        try:
+            self.run(batch)
+        finally:
+            for _ in batch:
+                self._slots.release()
+        elapsed = time.time() - start
+        logger.info(f'drained batch of {len(batch)} registration tasks in {elapsed} seconds')
+
+    def run(self, batch):
+        '''
+        Register a batch of (task, sequence). Tasks that have since been
+        superseded are skipped, and the rest are grouped by base volume so each
+        group is registered in one pass.
+        '''
+        groups = dict()
+        with self._lock:
+            for task,sequence in batch:
+                key = (task[0].series, task[0].instance)
+                if task[0].series in self._evicted:
+                    logger.debug(f'skipping registration task for {task[0].path} of evicted series')
+                    self._latest.pop(key, None)
+                    continue
+                if self._latest.get(key) != sequence:
+                    logger.debug(f'skipping superseded registration task for {task[0].path}')
+                    continue
+                groups.setdefault(task[1].path, list()).append((task, sequence))
+        for entries in groups.values():
+            self.run_group(entries)
+
+    def run_group(self, entries):
+        #### create nii files, run 3dvolreg and insert arrays into task volreg key-value pairs
+        base = entries[0][0][1]
+        moving = [task[0] for task,_ in entries]
+        # cached volumes this group uses, another worker must not evict them
+        pins = list()
+        try:
+            for task,_ in entries:
+                self.check_dicoms(task)
 
             start = time.time()
 
-            nii1, nii2, dcm1, dcm2 = self.create_niis(task_idx)
-
-            arr = self.run_volreg(nii1, nii2, self.out_dir)
-
-            self.clean_dir(nii1, nii2, self.out_dir)
-
-            logger.info(f'volreg array from registering volume {int(pydicom.dcmread(dcm2, force=True, stop_before_pixels=True).InstanceNumber)} to volume {int(pydicom.dcmread(dcm1, force=True, stop_before_pixels=True).InstanceNumber)}: {arr}')
+            if self._backend == 'rigid':
+                arrs = self.run_rigid(base, moving, pins)
+            else:
+                arrs = self.run_afni(base, moving, pins)
 
-            self.insert_array(arr, task_idx)
+            for (task,sequence),arr in zip(entries, arrs):
+                logger.info(f'volreg array from registering volume {task[0].instance} to volume {base.instance}: {arr}')
+                self.insert_array(arr, task, sequence)
 
             elapsed = time.time() - start
 
-            logger.info(f'processing took {elapsed} seconds')
-
-
-    def get_num_tasks(self):
-        self.num_tasks = len(self.tasks)
-
-    def create_niis(self, task_idx):
-        dcm1 = self.tasks[task_idx][1]['path']
-        nii1 = self.run_dcm2niix(dcm1, 1)
-
-        dcm2 = self.tasks[task_idx][0]['path']
-        nii2 = self.run_dcm2niix(dcm2, 2)
-
-        return nii1, nii2, dcm1, dcm2
+            logger.info(f'registering {len(entries)} volumes to volume {base.instance} took {elapsed} seconds')
 
-    def insert_array(self, arr, task_idx):
-        self.tasks[task_idx][0]['volreg'] = arr
+            logger.debug(f'volume cache hits={self._cache.hits} misses={self._cache.misses}')
+        except Exception as e:
+            logger.error(f'unable to register {len(entries)} volumes to {base.path}: {e}')
+            logger.exception(e, exc_info=True)
+        finally:
+            self._cache.unpin(*pins)
 
+    def run_afni(self, base, moving, pins=None):
+        '''
+        Convert every dicom and register all of the moving volumes with a single
+        3dvolreg call. More than one moving volume is first concatenated into
+        one multi-volume input with 3dTcat.
+        '''
+        nii1 = self.run_dcm2niix(base.path, base.instance, pins)
+        niis = list()
+        for task in moving:
+            niis.append(self.run_dcm2niix(task.path, task.instance, pins))
+            self._timings.stamp(task.series, task.instance, 'converted')
+
+        # the same volume can be registered on two workers at once (e.g., a
+        # late arrival in chain mode re-queues a neighbour that is running),
+        # so every group writes to a hidden directory of its own
+        out_dir = tempfile.mkdtemp(prefix='.volreg_', dir=os.path.dirname(moving[-1].path))
+        try:
+            mocopar = os.path.join(out_dir, 'moco.par')
+            if len(niis) == 1:
+                return self.run_volreg(nii1, niis[0], mocopar)
+            nii2 = os.path.join(out_dir, 'batch.nii')
+            self.run_tcat(niis, nii2)
+            return self.run_volreg(nii1, nii2, mocopar)
+        finally:
+            self.clean_dir(out_dir)
+
+    def insert_array(self, arr, task, sequence):
+        with self._lock:
+            key = (task[0].series, task[0].instance)
+            if self._latest.get(key) != sequence:
+                logger.debug(f'discarding stale registration result for {task[0].path}')
+                return
+            del self._latest[key]
+        self._timings.stamp(task[0].series, task[0].instance, 'registered')
+        pub.sendMessage(topic('registered', self._namespace), series=task[0].series, instance=task[0].instance, volreg=arr)
+
+
+    def run_dcm2niix(self, dicom, num, pins=None):
+        '''
+        With pins, the converted file is pinned in the cache and is not
+        removed until the caller unpins it
+        '''
+        nii_file = self._cache.get_or_load(
+            (dicom, num),
+            lambda: self.convert(dicom, num),
+            pins
+        )
+        if not os.path.exists(nii_file):
+            logger.debug(f'cached {nii_file} was removed, converting again')
+            nii_file = self.convert(dicom, num)
+            self._cache.put((dicom, num), nii_file)
+        return nii_file
 
-    def run_dcm2niix(self, dicom, num):
-
-        self.out_dir = os.sep.join(dicom.split(os.sep)[:-1])
+    def convert(self, dicom, num):
+        '''
+        Convert one dicom into a hidden directory of its own next to it, so
+        volumes with the same InstanceNumber from different series in one
+        folder never clash, and return the file dcm2niix wrote there
+        '''
+        out_dir = tempfile.mkdtemp(prefix=f'.bold_{num:06d}_', dir=os.path.dirname(dicom))
 
         dcm2niix_cmd = [
            'dcm2niix',
-           '-b', 'y',
+           '-b', 'n',
            #'-z', 'y',
            '-s', 'y',
-           '-f', f'bold_{num}',
-           '-o', self.out_dir,
+           '-f', f'bold_{num:06d}',
+           '-o', out_dir,
            dicom
         ]
 
-        output = subprocess.check_output(dcm2niix_cmd, stderr=subprocess.STDOUT)
-
-        logger.debug(f'dcm2niix output: {output}')
+        try:
+            output = subprocess.check_output(dcm2niix_cmd, stderr=subprocess.STDOUT)
+            logger.debug(f'dcm2niix output: {output}')
+            return self.find_nii(out_dir)
+        except Exception:
+            shutil.rmtree(out_dir, ignore_errors=True)
+            raise
 
-        nii_file = self.find_nii(self.out_dir, num)
+    def run_tcat(self, niis, prefix):
+        cmd = [
+            '3dTcat',
+            '-overwrite',
+            '-prefix', prefix
+        ] + niis
 
-        return nii_file
+        _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
 
-    def run_volreg(self, nii_1, nii_2, outdir):
-        mocopar = os.path.join(outdir, f'moco.par')
-        maxdisp = os.path.join(outdir, f'maxdisp')
+    def run_volreg(self, nii_1, nii_2, mocopar):
+        '''
+        Returns one [roll, pitch, yaw, dS, dL, dP] list per volume in nii_2
+        '''
         cmd = [
             '3dvolreg',
             '-base', nii_1,
@@ -115,36 +321,66 @@ class VolReg:
 
         _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
 
-        arr = np.loadtxt(mocopar)
+        arr = np.loadtxt(mocopar, ndmin=2)
 
-        arr = list(arr)
+        arrs = [list(row) for row in arr]
 
-        return arr
+        return arrs
 
-    def check_dicoms(self, task_idx):
-        if self.tasks[task_idx][1]['path'] == self.tasks[task_idx][0]['path']:
-            logger.warning(f'the two input dicom files are the same. registering {os.path.basename(self.tasks[task_idx][1]["path"])} to itself will yield 0s')
+    def run_rigid(self, base, moving, pins=None):
+        '''
+        Register each moving dicom to the base dicom in-process, without writing
+        anything to disk. The base is decoded and prepared once for the whole
+        batch and kept in the cache for later batches against the same base.
+        Returns the same [roll, pitch, yaw, dS, dL, dP] vectors as run_volreg.
+        '''
+        volume = self.decode(base.path, base.instance, pins)
+        prepared = self._cache.get_or_load(
+            (base.path, 'prepared'),
+            lambda: self._rigid.prepare(volume),
+            pins
+        )
+        arrs = list()
+        for task in moving:
+            data = self.decode(task.path, task.instance, pins)
+            self._timings.stamp(task.series, task.instance, 'converted')
+            arrs.append(self._rigid.register(volume, data, prepared))
+        return arrs
+
+    def decode(self, dicom, num, pins=None):
+        return self._cache.get_or_load(
+            (dicom, num),
+            lambda: Volume.from_dicom(dicom),
+            pins
+        )
+
+    def evict(self, value):
+        '''
+        Cached dcm2niix output lives in its own directory next to the dicoms
+        and must be removed once it falls out of the cache. Decoded in-memory
+        volumes need nothing.
+        '''
+        if not isinstance(value, str):
+            return
+        shutil.rmtree(os.path.dirname(value), ignore_errors=True)
+
+    def check_dicoms(self, task):
+        if task[1].path == task[0].path:
+            logger.warning(f'the two input dicom files are the same. registering {os.path.basename(task[1].path)} to itself will yield 0s')
             return True
         else:
             return False
 
-    def clean_dir(self, nii_1, nii_2, outdir):
-        #os.remove(nii_1)
-        #os.remove(nii_2)
-        #os.remove(f'{outdir}/maxdisp_delt')
-        #os.remove(f'{outdir}/maxdisp')
-        os.remove(f'{outdir}/moco.par')
-        for file in glob.glob(f'{outdir}/*.json'):
-            os.remove(file)
-        #for file in glob.glob(f'{outdir}/*.nii.gz'):
-        for file in glob.glob(f'{outdir}/*.nii'):
-            os.remove(file)
-
-
-    def find_nii(self, directory, num):
-        for file in os.listdir(directory):
-            if f'bold_{num}' in file and file.endswith('.nii'):#file.endswith('.gz'):
-                return os.path.join(directory, file)
+    def clean_dir(self, out_dir):
+        # converted .nii files are kept for reuse and removed on cache eviction
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+    def find_nii(self, directory):
+        niis = [file for file in os.listdir(directory) if file.endswith('.nii')]
+        if len(niis) != 1:
+            raise FileNotFoundError(f'expected one .nii file from dcm2niix in {directory}, found {niis}')
+        return os.path.join(directory, niis[0])
 
     def mock(self):
         return [
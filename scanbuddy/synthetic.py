@@ -0,0 +1,233 @@
+import logging
+import numpy as np
+from pathlib import Path
+from pydicom.sequence import Sequence
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from scanbuddy.proc.motion import COLUMNS
+from scanbuddy.proc.rigid import geometry, sample
+
+logger = logging.getLogger(__name__)
+
+ENHANCED_MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4.1'
+SIEMENS_CREATOR = 'SIEMENS MR SDI 02'
+
+# the axes 3dvolreg rotates about, in DICOM patient coordinates (LPS)
+INFERIOR = np.array([0.0, 0.0, -1.0])
+RIGHT = np.array([-1.0, 0.0, 0.0])
+ANTERIOR = np.array([0.0, -1.0, 0.0])
+
+def phantom(rows=64, cols=64, slices=32):
+    '''
+    An ellipsoid head with a brighter off-center blob, so that every rotation
+    is visible to registration
+    '''
+    z,y,x = np.indices((slices, rows, cols), dtype=float)
+    head = np.exp(-(((x - cols / 2) / (cols / 5)) ** 2 + ((y - rows / 2) / (rows / 4)) ** 2 + ((z - slices / 2) / (slices / 4)) ** 2))
+    blob = np.exp(-(((x - 0.6 * cols) / 4) ** 2 + ((y - 0.4 * rows) / 5) ** 2 + ((z - 0.3 * slices) / 3) ** 2))
+    return 1000 * head + 300 * blob
+
+def dataset(shape, instance, study, series, spacing=3.0, tr=0.8, coil='HeadNeck_64', coil_elements='HC1-7'):
+    '''
+    An enhanced multi-frame MR dataset laid out like a Siemens XA EPI volume,
+    one frame per slice, without pixel data. The receive coil and coil
+    elements are stored where Params.findcoil and findcoilelements read them.
+    '''
+    slices,rows,cols = shape
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = ENHANCED_MR_IMAGE_STORAGE
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = ENHANCED_MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'NONE']
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'Siemens Healthineers'
+    ds.ManufacturerModelName = 'SYNTHETIC'
+    ds.StudyInstanceUID = study
+    ds.SeriesInstanceUID = series
+    ds.InstanceNumber = instance
+    ds.StudyDescription = 'SYNTHETIC'
+    ds.SeriesDescription = 'synthetic_bold'
+    ds.ProtocolName = 'synthetic_bold'
+    ds.SeriesNumber = 1
+    ds.PatientID = 'SYNTHETIC'
+    ds.PatientName = 'SYNTHETIC^PHANTOM'
+    ds.Rows = rows
+    ds.Columns = cols
+    ds.NumberOfFrames = slices
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+
+    shared = Dataset()
+    orientation = Dataset()
+    orientation.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    shared.PlaneOrientationSequence = Sequence([orientation])
+    measures = Dataset()
+    measures.PixelSpacing = [spacing, spacing]
+    measures.SliceThickness = spacing
+    measures.SpacingBetweenSlices = spacing
+    shared.PixelMeasuresSequence = Sequence([measures])
+    timing = Dataset()
+    timing.RepetitionTime = tr * 1000
+    timing.FlipAngle = 52
+    shared.MRTimingAndRelatedParametersSequence = Sequence([timing])
+    echo = Dataset()
+    echo.EffectiveEchoTime = 30
+    shared.MREchoSequence = Sequence([echo])
+    receive = Dataset()
+    receive.ReceiveCoilName = coil
+    shared.MRReceiveCoilSequence = Sequence([receive])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    frames = list()
+    origin = [-spacing * cols / 2, -spacing * rows / 2, -spacing * slices / 2]
+    for i in range(slices):
+        frame = Dataset()
+        position = Dataset()
+        position.ImagePositionPatient = [origin[0], origin[1], origin[2] + i * spacing]
+        frame.PlanePositionSequence = Sequence([position])
+        content = Dataset()
+        content.InStackPositionNumber = i + 1
+        frame.FrameContentSequence = Sequence([content])
+        elements = Dataset()
+        elements.add_new((0x0021, 0x0011), 'LO', SIEMENS_CREATOR)
+        elements.add_new((0x0021, 0x114f), 'LO', coil_elements)
+        frame.add_new((0x0021, 0x0011), 'LO', SIEMENS_CREATOR)
+        frame.add_new((0x0021, 0x11fe), 'SQ', Sequence([elements]))
+        frames.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(frames)
+    return ds
+
+def rotation(axis, degrees):
+    '''
+    Counterclockwise (right-handed) rotation about a unit axis
+    '''
+    theta = np.radians(degrees)
+    k = np.array([
+        [0, -axis[2], axis[1]],
+        [axis[2], 0, -axis[0]],
+        [-axis[1], axis[0], 0]
+    ])
+    return np.eye(3) + np.sin(theta) * k + (1 - np.cos(theta)) * k @ k
+
+def motion(params, center):
+    '''
+    The head motion that 3dvolreg reports as [roll, pitch, yaw, dS, dL, dP].
+    This is written from the 3dvolreg documentation and does not use the
+    rigid engine's transform, so a benchmark against it can catch a
+    convention mismatch. The realignment back to the base is
+    3drotate -rotate <roll>I <pitch>R <yaw>A, i.e. roll about the inferior
+    axis first, then pitch and yaw, about the center of the volume. The
+    motion is its inverse, and it moves the center dS, dL and dP mm toward
+    superior, left and posterior.
+    '''
+    roll, pitch, yaw, dS, dL, dP = params
+    realign = rotation(ANTERIOR, yaw) @ rotation(RIGHT, pitch) @ rotation(INFERIOR, roll)
+    rot = realign.T
+    shift = -dS * INFERIOR - dL * RIGHT - dP * ANTERIOR
+    T = np.eye(4)
+    T[:3, :3] = rot
+    T[:3, 3] = center + shift - rot @ center
+    return T
+
+def decompose(T, center, guess=None, max_iter=50):
+    '''
+    The [roll, pitch, yaw, dS, dL, dP] whose motion is T, solved numerically
+    so that it only depends on motion()
+    '''
+    params = np.zeros(len(COLUMNS)) if guess is None else np.array(guess, dtype=float)
+    step = 1e-6
+    for _ in range(max_iter):
+        residual = (motion(params, center) - T)[:3].ravel()
+        if np.max(np.abs(residual)) < 1e-12:
+            break
+        jacobian = np.empty((residual.size, len(params)))
+        for i in range(len(params)):
+            delta = np.zeros(len(params))
+            delta[i] = step
+            jacobian[:, i] = (motion(params + delta, center) - motion(params - delta, center))[:3].ravel() / (2 * step)
+        params = params - np.linalg.lstsq(jacobian, residual, rcond=None)[0]
+    return params
+
+def move(data, affine, params):
+    '''
+    Resample data as if the head moved by [roll, pitch, yaw, dS, dL, dP]
+    about the center of the volume, the result that registering it to the
+    unmoved data should return
+    '''
+    center = affine[:3, :3] @ ((np.array(data.shape) - 1) / 2) + affine[:3, 3]
+    ijk = np.indices(data.shape).reshape(3, -1)
+    points = np.vstack([ijk, np.ones(ijk.shape[1])])
+    coords = np.linalg.inv(affine) @ np.linalg.inv(motion(params, center)) @ affine @ points
+    values,_ = sample(data, coords[:3])
+    return values.reshape(data.shape)
+
+def expected(trajectory, base, center):
+    '''
+    Ground truth registration result for every volume against volume index
+    base, or against the previous volume when base is None (chain mode)
+    '''
+    truth = list()
+    for i,params in enumerate(trajectory):
+        reference = trajectory[max(0, i - 1) if base is None else base]
+        T = motion(params, center) @ np.linalg.inv(motion(reference, center))
+        truth.append(decompose(T, center, guess=np.subtract(params, reference)))
+    return np.array(truth)
+
+def random_walk(num_vols, step=0.05, seed=None):
+    '''
+    A drifting trajectory with steps of the given standard deviation in
+    degrees and millimeters, starting at rest
+    '''
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, step, (num_vols, len(COLUMNS)))
+    steps[0] = 0
+    return np.cumsum(steps, axis=0)
+
+def load_trajectory(path, num_vols):
+    '''
+    A whitespace delimited file with [roll, pitch, yaw, dS, dL, dP] per
+    volume, the same layout as a 3dvolreg -1Dfile. The last row is held when
+    there are fewer rows than volumes.
+    '''
+    trajectory = np.loadtxt(path, ndmin=2)
+    if trajectory.shape[1] != len(COLUMNS):
+        raise ValueError(f'{path} must have {len(COLUMNS)} columns')
+    if len(trajectory) < num_vols:
+        trajectory = np.vstack([trajectory, np.repeat(trajectory[-1:], num_vols - len(trajectory), axis=0)])
+    return trajectory[:num_vols]
+
+def write_series(directory, num_vols, study=None, series=None, rows=64, cols=64, slices=32,
+                 trajectory=None, noise=0.0, seed=None, **kwargs):
+    '''
+    Write num_vols volumes of one series to directory and return their paths
+    in acquisition order. Volume i is the phantom moved by trajectory[i],
+    which is also saved to truth.1D. Extra keyword arguments go to dataset.
+    '''
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    study = study or generate_uid()
+    series = series or generate_uid()
+    if trajectory is None:
+        trajectory = np.zeros((num_vols, len(COLUMNS)))
+    rng = np.random.default_rng(seed)
+    data = phantom(rows, cols, slices)
+    paths = list()
+    for instance,params in enumerate(trajectory[:num_vols], start=1):
+        ds = dataset(data.shape, instance, study, series, **kwargs)
+        affine = geometry(ds, slices)
+        moved = move(data, affine, params) if np.any(params) else data
+        if noise:
+            moved = moved + rng.normal(0, noise, moved.shape)
+        ds.PixelData = np.clip(moved, 0, 4095).astype(np.uint16).tobytes()
+        path = directory / f'{instance:06d}.dcm'
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    np.savetxt(directory / 'truth.1D', trajectory[:num_vols], fmt='%.6f')
+    return paths
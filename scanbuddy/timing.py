@@ -0,0 +1,116 @@
+import time
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# in the order a volume passes through them, from the file landing to its
+# point being sent to a browser
+STAGES = (
+    'detect',
+    'complete',
+    'header',
+    'moved',
+    'converted',
+    'registered',
+    'published',
+    'rendered'
+)
+
+class Timings:
+    '''
+    Stamps every volume, by SeriesInstanceUID and InstanceNumber, as it
+    reaches each pipeline stage.
+    The time spent in a stage is measured from the previous stage the volume
+    reached, and detect to rendered is kept as the total. A stage is only
+    stamped the first time a volume reaches it, so re-registration or a full
+    redraw does not count twice.
+    '''
+    def __init__(self, maxlen=4096):
+        self._maxlen = maxlen
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._volumes = OrderedDict()
+            self._samples = {stage: deque(maxlen=self._maxlen) for stage in STAGES[1:] + ('total',)}
+
+    def clear_samples(self):
+        '''
+        Start a new latency summary but keep the stamps of every volume, which
+        may still belong to a series that is being written
+        '''
+        with self._lock:
+            for samples in self._samples.values():
+                samples.clear()
+
+    def stamp(self, series, instance, stage, when=None):
+        when = time.monotonic() if when is None else when
+        key = (series, instance)
+        with self._lock:
+            stamps = self._volumes.get(key)
+            if stamps is None:
+                stamps = self._volumes[key] = dict()
+                if len(self._volumes) > self._maxlen:
+                    self._volumes.popitem(last=False)
+            if stage in stamps:
+                return
+            stamps[stage] = when
+            previous = [stamps[s] for s in STAGES[:STAGES.index(stage)] if s in stamps]
+            if previous:
+                self._samples[stage].append(when - previous[-1])
+            if stage == STAGES[-1] and STAGES[0] in stamps:
+                self._samples['total'].append(when - stamps[STAGES[0]])
+
+    def summary(self):
+        '''
+        Number of samples and p50, p95 and max in milliseconds per stage
+        '''
+        with self._lock:
+            samples = {stage: np.array(values) * 1000 for stage,values in self._samples.items()}
+        summary = dict()
+        for stage,values in samples.items():
+            if not len(values):
+                continue
+            p50,p95 = np.percentile(values, [50, 95])
+            summary[stage] = {
+                'count': len(values),
+                'p50': round(float(p50), 3),
+                'p95': round(float(p95), 3),
+                'max': round(float(values.max()), 3)
+            }
+        return summary
+
+    def volumes(self):
+        '''
+        Stamps per SeriesInstanceUID and InstanceNumber as wall clock times, so
+        they can be compared with times taken by another process (e.g.,
+        scripts/simulator.py)
+        '''
+        offset = time.time() - time.monotonic()
+        volumes = dict()
+        with self._lock:
+            for (series,instance),stamps in self._volumes.items():
+                volumes.setdefault(series, dict())[instance] = {stage: when + offset for stage,when in stamps.items()}
+        return volumes
+
+    def log_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        logger.info('stage latency since the last new series (ms)')
+        for stage,values in summary.items():
+            logger.info(f'{stage:>10} n={values["count"]} p50={values["p50"]} p95={values["p95"]} max={values["max"]}')
+
+timings = Timings()
+
+# one set of timings per scanner, the unnamed scanner uses timings
+registry = {None: timings}
+registry_lock = threading.Lock()
+
+def for_namespace(namespace=None):
+    with registry_lock:
+        return registry.setdefault(namespace or None, Timings())
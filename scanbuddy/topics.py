@@ -0,0 +1,9 @@
+def topic(name, namespace=None):
+    '''
+    Name of a pipeline topic for one scanner. Each namespace is its own
+    PyPubSub topic tree, so pipelines that share a process never receive
+    each other's messages. Without a namespace the plain topic is used.
+    '''
+    if not namespace:
+        return name
+    return f'{namespace}.{name}'
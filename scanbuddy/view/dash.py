@@ -1,16 +1,26 @@
 import os
 import sys
+import time
 import dash
-import redis
 import random
 import secrets
 import logging
+import threading
 import pandas as pd
-from pubsub import pub
+from collections import OrderedDict
+from urllib.parse import parse_qs
 import plotly.express as px
 import dash_auth
+from flask import Response, jsonify, request
 from dash import Dash, html, dcc, callback, Output, Input, State
 import dash_bootstrap_components as dbc
+from scanbuddy.proc.instances import Instances
+from scanbuddy.proc.motion import MotionStore, COLUMNS
+from scanbuddy.view.push import Broadcaster
+from scanbuddy.bus import bus
+from scanbuddy.topics import topic
+from scanbuddy.timing import for_namespace
+from scanbuddy.broker.redis import MessageBroker
 
 logger = logging.getLogger(__name__)
 
@@ -24,25 +34,44 @@ ERROR_ART = """
 """
 DEFAULT_MESSAGE = 'Hello, World!'
 
+# opens one EventSource per page, for the scanner named by the page path, and
+# forwards each event to the matching dcc.Store
+PUSH_SCRIPT = """
+function(id) {
+    if (!window.scanbuddyEvents) {
+        const prefix = '%s';
+        const source = new EventSource(prefix + 'events/' + window.location.pathname.slice(prefix.length));
+        ['motion', 'message'].forEach(function(kind) {
+            source.addEventListener(kind, function(event) {
+                window.dash_clientside.set_props(kind + '-event', {data: JSON.parse(event.data)});
+            });
+        });
+        window.scanbuddyEvents = source;
+    }
+    return window.dash_clientside.no_update;
+}
+"""
+
 class View:
-    def __init__(self, host='127.0.0.1', port=8080, config=None, debug=False):
+    def __init__(self, host='127.0.0.1', port=8080, config=None, debug=False, broker=None, scanners=None):
+        '''
+        One dashboard for every scanner. Each scanner is served at /<name>,
+        and the first one is also served at /.
+        '''
         self._config = config
         self._host = self._config.find_one('$.app.host', default=host)
         self._port = self._config.find_one('$.app.port', default=port)
         self._debug = self._config.find_one('$.app.debug', default=debug)
         self._title = self._config.find_one('$.app.title', default='Realtime fMRI Motion')
-        self._subtitle = 'Ready'
-        self._num_warnings = 0
-        self._instances = dict()
-        self._redis_client = redis.StrictRedis(
-            host=self._config.find_one('$.broker.host', default='127.0.0.1'),
-            port=self._config.find_one('$.broker.port', default=6379),
-            db=0
-        )
+        self._scanners = {name: Scanner(name) for name in scanners or [None]}
+        self._default = next(iter(self._scanners.values()))
+        self._broker = broker
+        if not self._broker:
+            self._broker = MessageBroker.from_config(self._config)
         self.init_app()
         self.init_page()
         self.init_callbacks()
-        pub.subscribe(self.listener, 'plot')
+        self.init_push()
 
     def init_app(self):
         self._app = Dash(
@@ -107,18 +136,28 @@ class View:
         )   
 
         subtitle = dbc.NavItem(
-            self._subtitle,
+            'Ready',
             id='sub-title',
             style={
                 'color': '#e2ded0'
             }
         )   
 
+        # a full page load reconnects the event stream to the chosen scanner
+        prefix = self._app.config.requests_pathname_prefix
+        scanners = dbc.Nav([
+            dbc.NavLink(name, href=f'{prefix}{name}', external_link=True)
+            for name in self._scanners if name
+        ])
+
         navbar = dbc.Navbar(
             dbc.Container([
                 dbc.Row(
                     dbc.Col(branding),
                 ),
+                dbc.Row(
+                    dbc.Col(scanners, class_name='ms-2'),
+                ),
                 dbc.Row(
                     dbc.Col(subtitle, class_name='g-0 ms-auto flex-nowrap mt-3 mt-md-0')
                 ),
@@ -354,30 +393,37 @@ class View:
                     'textAlign': 'center',
                 }
             ),
-            dcc.Interval(
-                id='plot-interval-component',
-                interval=1 * 1000
-            ),
-            dcc.Interval(
-                id='message-interval-component',
-                interval=1 * 1000
-            )
+            dcc.Location(id='url'),
+            dcc.Store(id='graph-cursor'),
+            dcc.Store(id='push-source'),
+            dcc.Store(id='motion-event'),
+            dcc.Store(id='message-event')
         ])
 
 
     def init_callbacks(self):
         self._app.callback(
             Output('live-update-displacements', 'figure'),
+            Output('live-update-displacements', 'extendData'),
             Output('live-update-rotations', 'figure'),
+            Output('live-update-rotations', 'extendData'),
             Output('sub-title', 'children'),
-            Input('plot-interval-component', 'n_intervals'),
-        )(self.update_graphs)
+            Output('graph-cursor', 'data'),
+            Output('number-of-vols', 'children'),
+            Output('movements-05mm', 'children'),
+            Output('movements-1mm', 'children'),
+            Output('max-abs-motion', 'children'),
+            Input('motion-event', 'data'),
+            State('graph-cursor', 'data'),
+            State('url', 'pathname'),
+            State('url', 'search'),
+        )(self.update)
 
         self._app.callback(
             Output('bsod-dialog', 'open', allow_duplicate=True),
             Output('bsod-content', 'children', allow_duplicate=True),
             Output('notification-badge', 'children'),
-            Input('message-interval-component', 'n_intervals'),
+            Input('message-event', 'data'),
             prevent_initial_call=True
         )(self.check_messages)
 
@@ -388,51 +434,170 @@ class View:
             prevent_initial_call=True
         )(self.close_bsod)
 
-        self._app.callback(
-            Output('number-of-vols', 'children'),
-            Output('movements-05mm', 'children'),
-            Output('movements-1mm', 'children'),
-            Output('max-abs-motion', 'children'),
-            Input('plot-interval-component', 'n_intervals'),
-        )(self.update_metrics)
+        self._app.clientside_callback(
+            PUSH_SCRIPT % self._app.config.requests_pathname_prefix,
+            Output('push-source', 'data'),
+            Input('push-source', 'id')
+        )
 
-    def check_messages(self, n_intervals):
-        try:
-            message = self._redis_client.get('scanbuddy_messages')
-            if message:
-                self._num_warnings += 1
-                self._redis_client.delete('scanbuddy_messages')
-                return True, message.decode(), self._num_warnings
-        except redis.exceptions.ConnectionError as e:
-            logger.warning(f'unable to get messages from message broker, service unavailable')
+    def init_push(self):
+        '''
+        Browsers hold one server-sent event stream open and only run callbacks
+        when a volume is registered or a message arrives, so an idle session
+        costs nothing. A single thread blocks on the message broker on behalf
+        of every client.
+        '''
+        for rule in ('/events', '/events/', '/events/<name>'):
+            self._app.server.add_url_rule(rule, f'events{rule}', self.events)
+        for rule in ('/metrics', '/metrics/<name>'):
+            self._app.server.add_url_rule(rule, f'metrics{rule}', self.metrics)
+        for scanner in self._scanners.values():
+            threading.Thread(
+                target=self.poll_messages,
+                args=(scanner,),
+                name=f'message-poller-{scanner.name}' if scanner.name else 'message-poller',
+                daemon=True
+            ).start()
+
+    def scanner(self, name=None):
+        '''
+        The scanner for a name or page path, the first scanner if there is no
+        such scanner
+        '''
+        if name:
+            if name.startswith('/'):
+                name = name[len(self._app.config.requests_pathname_prefix):].strip('/')
+        return self._scanners.get(name or None, self._default)
+
+    def events(self, name=None):
+        scanner = self.scanner(name)
+        initial = [('motion', {'version': scanner.get().motion.version})]
+        return Response(
+            scanner.events.stream(initial),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
 
-        return dash.no_update,dash.no_update,dash.no_update
+    def metrics(self, name=None):
+        '''
+        Per-stage latency since the newest series of a scanner started, its
+        active series, the depth of each pipeline queue, connected clients
+        and message broker statistics. With
+        ?volumes=1 the stamps of every volume are included as well. Any active
+        series can be shown with ?series=<SeriesInstanceUID> on the page.
+        '''
+        scanner = self.scanner(name)
+        metrics = {
+            'scanner': scanner.name,
+            'scanners': [name for name in self._scanners if name],
+            'series': scanner.active(),
+            'stages': scanner.timings.summary(),
+            'queues': bus.stats(scanner.name),
+            'clients': len(scanner.events),
+            'broker': self._broker.stats()
+        }
+        if request.args.get('volumes'):
+            metrics['volumes'] = scanner.timings.volumes()
+        return jsonify(metrics)
+
+    def poll_messages(self, scanner, block=5000):
+        '''
+        Every message published for a scanner after the view started is
+        delivered, in order, to every client connected to that scanner
+        '''
+        stream = topic('scanbuddy_messages', scanner.name)
+        last_id = None
+        while True:
+            if last_id is None:
+                last_id = self._broker.last_id(stream)
+                if last_id is None:
+                    time.sleep(block / 1000)
+                    continue
+            for last_id,message in self._broker.read(stream, last_id, block=block):
+                scanner.num_warnings += 1
+                scanner.message = message
+                scanner.events.publish('message', {
+                    'count': scanner.num_warnings,
+                    'message': message
+                })
+
+    def check_messages(self, event):
+        if not event:
+            return dash.no_update,dash.no_update,dash.no_update
+        return True, event['message'], event['count']
 
     def close_bsod(self, n_clicks):
         return False, 'Hello, World!'
 
-    def update_graphs(self, n):
-        df = self.todataframe()
-        disps = self.displacements(df)
-        rots = self.rotations(df)
-        title = self.get_subtitle()
-        return disps,rots,title
-
-    def update_metrics(self, n):
-        df = self.todataframe()
-        num_vols = len(df)
-        movements_05mm = (df[['x', 'y', 'z']].abs() > 0.5).any(axis=1).sum() + (df[['x', 'y', 'z']].abs() < -0.5).any(axis=1).sum()
-        movements_1mm = (df[['x', 'y', 'z']].abs() > 1.0).any(axis=1).sum() + (df[['x', 'y', 'z']].abs() < -1.0).any(axis=1).sum()
-
-        if not df.empty:
-            max_abs_motion = round(df[['x', 'y', 'z']].abs().max().max(), 2)
-        else:
-            max_abs_motion = 0
-
-        return str(num_vols), str(movements_05mm), str(movements_1mm), str(max_abs_motion)
-
-    def get_subtitle(self):
-        return self._subtitle
+    def update(self, event, cursor, pathname=None, search=None):
+        '''
+        The page follows the newest series of its scanner unless the query
+        string asks for another active series with ?series=<SeriesInstanceUID>.
+
+        Each client keeps a cursor with the version of the page snapshot it last
+        received and how many points it has been sent. An unchanged version
+        skips every output. When the motion store has only appended rows since
+        the client's version, the new points are sent with extendData.
+        Otherwise, e.g., on a new series or a replaced estimate, both figures
+        are replaced. An empty figure has no traces to extend, so it is always
+        replaced.
+        '''
+        scanner = self.scanner(pathname)
+        series = parse_qs((search or '').lstrip('?')).get('series', [None])[0]
+        view = scanner.get(series)
+        page = self.snapshot(scanner, view)
+        if cursor and cursor['version'] == page.version:
+            return (dash.no_update,) * 10
+        motion = page.motion
+        extend = cursor and cursor['series'] == motion.series and cursor['rewrites'] == motion.rewrites and cursor['sent'] > 0
+        new_cursor = {
+            'version': page.version,
+            'series': motion.series,
+            'rewrites': motion.rewrites,
+            'sent': len(motion.N)
+        }
+        if view.uid:
+            for instance in motion.N[cursor['sent'] if extend else 0:]:
+                scanner.timings.stamp(view.uid, int(instance), 'rendered')
+        if extend:
+            sent = cursor['sent']
+            disps = self.extension(motion, sent, ['x', 'y', 'z'])
+            rots = self.extension(motion, sent, ['roll', 'pitch', 'yaw'])
+            return (dash.no_update,disps,dash.no_update,rots,dash.no_update,new_cursor) + page.metrics
+        disps,rots = page.figures()
+        return (disps,dash.no_update,rots,dash.no_update,page.subtitle,new_cursor) + page.metrics
+
+    def snapshot(self, scanner=None, view=None):
+        '''
+        The page snapshot for the current version of a series' motion store,
+        the newest series of the scanner by default, shared by every client
+        and rebuilt at most once per version
+        '''
+        scanner = scanner or self._default
+        view = view or scanner.get()
+        motion = view.motion
+        with scanner.lock:
+            if view.page is None or view.page.version != [motion.id, motion.version]:
+                view.page = PageSnapshot(self, motion.snapshot(), view.subtitle)
+            return view.page
+
+    def extension(self, snapshot, start, columns):
+        '''
+        extendData payload appending rows start: onwards to one trace per column,
+        in the same trace order px.line uses
+        '''
+        N = snapshot.N[start:].tolist()
+        indices = [COLUMNS.index(column) for column in columns]
+        return [
+            {
+                'x': [N] * len(indices),
+                'y': [snapshot.params[start:, i].tolist() for i in indices]
+            },
+            list(range(len(indices)))
+        ]
 
 
     def displacements(self, df):
@@ -639,13 +804,9 @@ class View:
         )
         return fig
 
-    def todataframe(self):
-        arr = list()
-        for i,instance in enumerate(self._instances.values(), start=1):
-            volreg = instance['volreg']
-            if volreg:
-                arr.append([i] + volreg)
-        df = pd.DataFrame(arr, columns=['N', 'roll', 'pitch', 'yaw', 'x', 'y', 'z'])
+    def todataframe(self, snapshot):
+        df = pd.DataFrame(snapshot.params, columns=COLUMNS)
+        df.insert(0, 'N', snapshot.N)
         return df
 
     def forever(self):
@@ -655,9 +816,127 @@ class View:
             debug=self._debug
         )
 
-    def listener(self, instances, subtitle_string):
-        self._instances = instances
-        self._subtitle = subtitle_string
+class Scanner:
+    '''
+    What the view keeps for one scanner: the motion store and subtitle of
+    every active series from its pipeline, with a page snapshot each shared
+    by its clients, and the browsers connected to its event stream
+    '''
+    def __init__(self, name=None):
+        self.name = name
+        self.idle = SeriesView()
+        self.series = OrderedDict()
+        self.newest = None
+        self.lock = threading.Lock()
+        self.events = Broadcaster()
+        self.timings = for_namespace(name)
+        self.num_warnings = 0
+        self.message = DEFAULT_MESSAGE
+        self.stage = bus.stage('view', name)
+        # a plot only hands over the latest motion store of a series, so
+        # only the most recent one matters
+        self.stage.subscribe(self.listener, 'plot', policy='latest', key='series')
+        self.stage.subscribe(self.registered, 'registered')
+        self.stage.subscribe(self.evict, 'evict')
+        self.stage.subscribe(self.reset, 'reset')
+
+    def get(self, uid=None):
+        '''
+        An active series, the newest series when there is no such series
+        '''
+        with self.lock:
+            view = self.series.get(uid) or self.series.get(self.newest)
+        return view or self.idle
+
+    def active(self):
+        with self.lock:
+            return [
+                {
+                    'series': view.uid,
+                    'subtitle': view.subtitle,
+                    'volumes': view.motion.num_vols,
+                    'instances': len(view.instances.snapshot()),
+                    'newest': view.uid == self.newest
+                }
+                for view in self.series.values()
+            ]
+
+    def listener(self, instances, motion, subtitle_string, series):
+        with self.lock:
+            view = self.series.get(series)
+            if view is None:
+                view = self.series[series] = SeriesView(series)
+                self.newest = series
+            view.instances = instances
+            view.subtitle = subtitle_string
+            view.motion = motion
+        self.events.publish('motion', {'version': motion.version})
+
+    def registered(self, series, instance, volreg):
+        view = self.get(series)
+        self.events.publish('motion', {'version': view.motion.version})
+        self.timings.stamp(series, instance, 'published')
+
+    def evict(self, series):
+        with self.lock:
+            self.series.pop(series, None)
+            if self.newest == series:
+                self.newest = next(reversed(self.series), None)
+
+    def reset(self):
+        '''
+        The watcher moved on to another session, only the newest series stays
+        on screen until the next one starts
+        '''
+        with self.lock:
+            newest = self.series.get(self.newest)
+            self.series.clear()
+            if newest:
+                self.series[newest.uid] = newest
+
+class SeriesView:
+    '''
+    The latest motion store, published instances and subtitle of one series.
+    Both are read through their snapshot(), which is safe from any thread.
+    '''
+    def __init__(self, uid=None, subtitle='Ready'):
+        self.uid = uid
+        self.subtitle = subtitle
+        self.instances = Instances(uid)
+        self.motion = MotionStore()
+        self.page = None
+
+class PageSnapshot:
+    '''
+    Everything the page shows for one version of the motion store. Metrics
+    are computed up front from the store's running counters, the DataFrame
+    and figures only when a client first needs a full redraw.
+    '''
+    def __init__(self, view, motion, subtitle):
+        self.motion = motion
+        self.version = [motion.series, motion.version]
+        self.subtitle = subtitle
+        movements_05mm, movements_1mm = motion.exceedances
+        max_abs_motion = round(motion.max_abs_motion, 2)
+        self.metrics = (
+            str(motion.num_vols),
+            str(movements_05mm),
+            str(movements_1mm),
+            str(max_abs_motion)
+        )
+        self._view = view
+        self._figures = None
+        self._lock = threading.Lock()
+
+    def figures(self):
+        with self._lock:
+            if self._figures is None:
+                df = self._view.todataframe(self.motion)
+                self._figures = (
+                    self._view.displacements(df),
+                    self._view.rotations(df)
+                )
+            return self._figures
 
 class AuthError(Exception):
     pass
@@ -0,0 +1,61 @@
+import json
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# a comment line keeps idle connections from being closed by proxies
+KEEPALIVE = ': keepalive\n\n'
+
+class Broadcaster:
+    '''
+    Fan out server-sent events to every connected browser. Events only tell
+    clients that something changed, so a client that falls behind simply
+    misses intermediate events instead of holding up everyone else.
+    '''
+    def __init__(self, maxsize=16, keepalive=15.0):
+        self._maxsize = maxsize
+        self._keepalive = keepalive
+        self._lock = threading.Lock()
+        self._clients = set()
+
+    def publish(self, kind, data):
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait((kind, data))
+            except queue.Full:
+                logger.debug(f'dropping {kind} event for a slow client')
+
+    def stream(self, initial=()):
+        '''
+        Generator of text/event-stream chunks for one client, starting with
+        the initial (kind, data) events
+        '''
+        client = queue.Queue(maxsize=self._maxsize)
+        with self._lock:
+            self._clients.add(client)
+        logger.debug(f'client connected, {len(self._clients)} connected')
+        try:
+            for kind,data in initial:
+                yield format_event(kind, data)
+            while True:
+                try:
+                    kind,data = client.get(timeout=self._keepalive)
+                except queue.Empty:
+                    yield KEEPALIVE
+                    continue
+                yield format_event(kind, data)
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+            logger.debug(f'client disconnected, {len(self._clients)} connected')
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+def format_event(kind, data):
+    return f'event: {kind}\ndata: {json.dumps(data)}\n\n'
@@ -0,0 +1,33 @@
+import logging
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+try:
+    from watchdog.observers.inotify import InotifyObserver
+except Exception:
+    # not on Linux
+    InotifyObserver = None
+
+logger = logging.getLogger(__name__)
+
+OBSERVERS = ('polling', 'native')
+
+def make_observer(kind, timeout):
+    '''
+    Polling rescans the directory every timeout seconds and is the only option
+    that works reliably on SMB/CIFS mounts. Native uses the platform event API
+    (inotify on Linux) and falls back to polling where none is available.
+    '''
+    if kind not in OBSERVERS:
+        raise ValueError(f'unknown observer "{kind}", expected one of {OBSERVERS}')
+    if kind == 'polling':
+        return PollingObserver(timeout=timeout)
+    if InotifyObserver and Observer is InotifyObserver:
+        # a file renamed in from outside the watched directory is reported as
+        # a move with an empty src_path, instead of a creation that is never
+        # followed by a close-write
+        return InotifyObserver(timeout=timeout, generate_full_events=True)
+    return Observer(timeout=timeout)
+
+def is_native(observer):
+    return not isinstance(observer, PollingObserver)
@@ -0,0 +1,239 @@
+import os
+import time
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+PIXEL_DATA = 0x7fe00010
+ITEM = 0xfffee000
+ITEM_DELIMITER = 0xfffee00d
+SEQUENCE_DELIMITER = 0xfffee0dd
+UNDEFINED = 0xffffffff
+LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+IMPLICIT_LITTLE = '1.2.840.10008.1.2'
+EXPLICIT_BIG = '1.2.840.10008.1.2.2'
+DEFLATED = ('1.2.840.10008.1.2.1.99',)
+
+class IncompleteDicomError(IOError):
+    pass
+
+class Truncated(Exception):
+    pass
+
+class Completeness:
+    '''
+    Base class for deciding when a file that is still being written is complete.
+    Subclasses implement is_complete. wait blocks until that returns True, polling
+    every interval seconds (with backoff) and giving up after timeout seconds.
+    '''
+    def __init__(self, interval=.005, max_interval=.1, timeout=10.0):
+        self._interval = interval
+        self._max_interval = max_interval
+        self._timeout = timeout
+
+    def wait(self, path):
+        start = time.monotonic()
+        interval = self._interval
+        while not self.is_complete(path):
+            if time.monotonic() - start > self._timeout:
+                raise IncompleteDicomError(f'{path} was not complete after {self._timeout} seconds')
+            time.sleep(interval)
+            interval = min(interval * 1.5, self._max_interval)
+        return time.monotonic() - start
+
+    def is_complete(self, path):
+        raise NotImplementedError()
+
+class SizeCompleteness(Completeness):
+    '''
+    A file is complete once two successive stat calls, one interval apart,
+    return the same size. This always costs at least one interval and is
+    fooled by writers that preallocate the file.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sizes = dict()
+
+    def is_complete(self, path):
+        size = os.stat(path).st_size
+        previous = self._sizes.get(path, -1)
+        if size == previous and size > 0:
+            self._sizes.pop(path, None)
+            return True
+        self._sizes[path] = size
+        return False
+
+class ParseCompleteness(Completeness):
+    '''
+    A file is complete once every element declared in its header, up to and
+    including Pixel Data, is present on disk. A file that already has that
+    size the first time it is seen may have been preallocated by the writer
+    (e.g., over SMB) and still be zero-filled, so it must also keep the same
+    size and mtime for one interval. Files that cannot be walked this way
+    (deflated transfer syntax, or no Pixel Data element) fall back to the
+    size strategy.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fallback = SizeCompleteness(*args, **kwargs)
+        # (size, mtime) of files first seen at their full size, None for files
+        # seen with a header but only part of the pixel data, which is only
+        # possible while a writer is streaming them
+        self._seen = dict()
+
+    def is_complete(self, path):
+        stat = os.stat(path)
+        try:
+            expected = expected_size(path)
+        except Truncated:
+            # possibly an empty file that is about to be preallocated
+            return False
+        if expected is None:
+            self._seen.pop(path, None)
+            return self._fallback.is_complete(path)
+        if stat.st_size < expected:
+            self._seen[path] = None
+            return False
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if path in self._seen:
+            previous = self._seen.pop(path)
+            if previous is None or previous == signature:
+                return True
+        self._seen[path] = signature
+        return False
+
+def expected_size(path):
+    '''
+    Walk the elements of a DICOM Part 10 file and return the byte offset at
+    which Pixel Data ends. Raises Truncated if the file ends part way through
+    an element or its header is still zero-filled, and returns None when the
+    size cannot be determined.
+    '''
+    with open(path, 'rb') as fo:
+        reader = Reader(fo, os.fstat(fo.fileno()).st_size)
+        reader.seek(128)
+        magic = reader.read(4)
+        if magic == bytes(4):
+            # preallocated, the header has not been written yet
+            raise Truncated()
+        if magic != b'DICM':
+            return None
+        transfer_syntax = reader.read_meta()
+        if transfer_syntax in DEFLATED:
+            return None
+        reader.explicit = transfer_syntax != IMPLICIT_LITTLE
+        reader.endian = '>' if transfer_syntax == EXPLICIT_BIG else '<'
+        try:
+            return reader.find_pixel_data()
+        except ValueError as e:
+            logger.debug(f'unable to walk {path}: {e}')
+            return None
+
+class Reader:
+    def __init__(self, fo, size):
+        self._fo = fo
+        self._size = size
+        self.explicit = True
+        self.endian = '<'
+
+    def seek(self, offset):
+        if offset > self._size:
+            raise Truncated()
+        self._fo.seek(offset)
+
+    def tell(self):
+        return self._fo.tell()
+
+    def read(self, n):
+        data = self._fo.read(n)
+        if len(data) < n:
+            raise Truncated()
+        return data
+
+    def read_meta(self):
+        '''
+        The file meta group is always explicit VR little endian
+        '''
+        transfer_syntax = None
+        while True:
+            offset = self.tell()
+            if offset + 2 > self._size:
+                raise Truncated()
+            group = struct.unpack('<H', self._fo.read(2))[0]
+            self.seek(offset)
+            if group != 0x0002:
+                return transfer_syntax
+            tag, vr, length = self.read_header(explicit=True, endian='<')
+            value = self.read(length)
+            if tag == 0x00020010:
+                transfer_syntax = value.decode('ascii').strip('\x00 ')
+
+    def read_header(self, explicit=None, endian=None):
+        explicit = self.explicit if explicit is None else explicit
+        endian = endian or self.endian
+        group, element = struct.unpack(f'{endian}HH', self.read(4))
+        tag = group << 16 | element
+        if group == 0xfffe:
+            return tag, None, struct.unpack(f'{endian}L', self.read(4))[0]
+        if not explicit:
+            return tag, None, struct.unpack(f'{endian}L', self.read(4))[0]
+        vr = self.read(2)
+        if vr in LONG_VRS:
+            self.read(2)
+            return tag, vr, struct.unpack(f'{endian}L', self.read(4))[0]
+        return tag, vr, struct.unpack(f'{endian}H', self.read(2))[0]
+
+    def find_pixel_data(self):
+        while self.tell() < self._size:
+            tag, vr, length = self.read_header()
+            if tag == PIXEL_DATA:
+                if length == UNDEFINED:
+                    self.skip_items()
+                    return self.tell()
+                return self.tell() + length
+            self.skip(vr, length)
+        return None
+
+    def skip(self, vr, length):
+        if length != UNDEFINED:
+            self.seek(self.tell() + length)
+            return
+        if vr == b'UN' or vr is None:
+            # undefined length UN and implicit VR sequences are encoded implicitly
+            explicit = self.explicit
+            self.explicit = False if vr == b'UN' else explicit
+            self.skip_items()
+            self.explicit = explicit
+            return
+        self.skip_items()
+
+    def skip_items(self):
+        '''
+        Skip the items of an undefined length sequence (or encapsulated pixel
+        data) up to and including the sequence delimiter
+        '''
+        while True:
+            tag, _, length = self.read_header()
+            if tag == SEQUENCE_DELIMITER:
+                return
+            if tag != ITEM:
+                raise ValueError(f'expected an item tag, found {tag:08x}')
+            if length != UNDEFINED:
+                self.seek(self.tell() + length)
+                continue
+            while True:
+                tag, vr, length = self.read_header()
+                if tag == ITEM_DELIMITER:
+                    break
+                self.skip(vr, length)
+
+STRATEGIES = {
+    'parse': ParseCompleteness,
+    'size': SizeCompleteness
+}
+
+def make_completeness(kind='parse', **kwargs):
+    if kind not in STRATEGIES:
+        raise ValueError(f'unknown completeness strategy "{kind}", expected one of {tuple(STRATEGIES)}')
+    return STRATEGIES[kind](**kwargs)
@@ -1,31 +1,103 @@
 import os
-import glob
 import time
 import shutil
+import threading
 import logging
 import pydicom
 from pubsub import pub
-from retry import retry
 from pathlib import Path
+from collections import OrderedDict
 from pydicom.errors import InvalidDicomError
-from watchdog.observers.polling import PollingObserver
-from watchdog.events import PatternMatchingEventHandler
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.events import PatternMatchingEventHandler, FileCreatedEvent
+from scanbuddy.topics import topic
+from scanbuddy.timing import for_namespace
+from scanbuddy.watcher import make_observer, is_native
+from scanbuddy.watcher.complete import make_completeness, IncompleteDicomError
 
 logger = logging.getLogger(__name__)
 
+# the only header elements read downstream of intake (Processor.listener and
+# Params), everything else, including private CSA headers, is skipped
+HEADER_TAGS = [
+    'StudyInstanceUID',
+    'SeriesInstanceUID',
+    'InstanceNumber',
+    'StudyDescription',
+    'SeriesDescription',
+    'SeriesNumber',
+    'PatientID',
+    'PatientName',
+    (0x5200, 0x9229),
+    (0x5200, 0x9230)
+]
+
+# enough to rebuild the instance index of a series after a restart
+RECOVERY_TAGS = [
+    'StudyInstanceUID',
+    'SeriesInstanceUID',
+    'InstanceNumber'
+]
+
+LAYOUTS = ('move', 'inplace')
+
+# registration output written next to the dicoms, and motion files such as the
+# truth.1D of a synthetic series
+IGNORE_PATTERNS = ['*.nii', '*.par', '*.1D']
+
+# evicted series remembered so that their late files are not mistaken for a
+# new series
+MAX_EVICTED = 64
+
+# directory removal can take seconds on a network share, so it is done in the background
+cleaner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cleanup')
+
+def remove_later(*paths):
+    '''
+    Remove files and directory trees on the cleanup thread
+    '''
+    cleaner.submit(remove, paths)
+
+def remove(paths):
+    for path in paths:
+        logger.debug(f'removing {path}')
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f'unable to remove {path}: {e}')
+
 class DicomWatcher:
-    def __init__(self, directory):
+    def __init__(self, directory, observer='polling', completeness='parse', layout='move', namespace=None, max_series=4):
         self._directory = directory
-        self._observer = PollingObserver(timeout=.01)
-        self._observer.schedule(
-            DicomHandler(ignore_directories=True),
-            directory
+        self._namespace = namespace
+        self._observer = make_observer(observer, timeout=.01)
+        self._handler = DicomHandler(
+            ignore_directories=True,
+            ignore_patterns=IGNORE_PATTERNS,
+            close_write=is_native(self._observer),
+            completeness=make_completeness(completeness),
+            layout=layout,
+            namespace=namespace,
+            max_series=max_series
         )
+        self._observer.schedule(self._handler, directory)
 
-    def start(self):
+    def start(self, recover=False):
+        '''
+        With recover, files already in the directory (e.g., from before a
+        restart) are picked up as well. The observer is started first, so a
+        file that lands while recovering is seen by at least one of the two.
+        '''
         logger.info(f'starting dicom watcher on {self._directory}')
         self._directory.mkdir(parents=True, exist_ok=True)
         self._observer.start()
+        if recover:
+            self._handler.recover(self._directory)
 
     def join(self):
         self._observer.join()
@@ -34,82 +106,281 @@ class DicomWatcher:
         logger.info(f'stopping dicom watcher on {self._directory}')
         self._observer.stop()
         logger.info(f'removing {self._directory}')
+        remove_later(self._directory)
+        pub.sendMessage(topic('reset', self._namespace))
+
+def read_header(dicom, tags=HEADER_TAGS):
+    return pydicom.dcmread(
+        dicom,
+        stop_before_pixels=True,
+        specific_tags=tags
+    )
+
+def read_recovery_header(dicom):
+    try:
+        ds = read_header(dicom, RECOVERY_TAGS)
+        int(ds.InstanceNumber)
+        return ds
+    except (InvalidDicomError, AttributeError, TypeError, ValueError) as e:
+        logger.debug(f'skipping {dicom} during recovery: {e}')
+    except FileNotFoundError:
+        pass
+    return None
+
+def signature(path, stat=None):
+    '''
+    Changes whenever a file is replaced or written to
+    '''
+    stat = stat or os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns)
+
+def stat_all(paths):
+    '''
+    (path, stat) of every path that still exists, a file can be removed
+    (e.g., by the cleanup thread) while a directory is being scanned
+    '''
+    for path in paths:
         try:
-            shutil.rmtree(self._directory)
-            pub.sendMessage('reset')
+            yield path, path.stat()
         except FileNotFoundError:
-            logger.info(f'{self._directory} does not exist, moving on')
-            pub.sendMessage('reset')
-            pass
+            logger.debug(f'{path} was removed during recovery')
 
 class DicomHandler(PatternMatchingEventHandler):
+    def __init__(self, *args, close_write=False, completeness=None, layout='move', namespace=None, max_series=4, **kwargs):
+        '''
+        With close_write, files are picked up when the writer closes them
+        (IN_CLOSE_WRITE) instead of when they are first created, and are known
+        to be complete. Otherwise the completeness strategy decides.
+
+        The move layout renames each file into <study>/<series>/. The inplace
+        layout leaves files where they land and only keeps an index of them.
+
+        Up to max_series series are tracked at once (e.g., a scan that is
+        still being sent while the next one starts). The series that least
+        recently received a file is evicted to make room for a new one.
+        '''
+        if layout not in LAYOUTS:
+            raise ValueError(f'unknown layout "{layout}", expected one of {LAYOUTS}')
+        self._close_write = close_write
+        self._completeness = completeness or make_completeness()
+        self._layout = layout
+        self._namespace = namespace
+        self._timings = for_namespace(namespace)
+        self._max_series = max(1, max_series)
+        self._active = OrderedDict()
+        self._evicted = OrderedDict()
+        self._series_dirs = dict()
+        self._index = dict()
+        # (inode, mtime) of the files recovery handed to the Processor in place
+        self._recovered = dict()
+        # recovery runs alongside the observer thread
+        self._lock = threading.RLock()
+        super().__init__(*args, **kwargs)
+
     def on_created(self, event):
+        if not self._close_write:
+            self.process(event)
+
+    def on_closed(self, event):
+        if self._close_write:
+            self.process(event)
+
+    def on_moved(self, event):
+        '''
+        A file renamed into the directory (e.g., by a writer that finishes
+        with a rename) is complete and fires neither a creation nor a
+        close-write for its new name. Moves out of the directory, including
+        this handler's own, have no dest_path here.
+        '''
+        if event.dest_path and self.is_candidate(Path(event.dest_path)):
+            self.process(FileCreatedEvent(event.dest_path))
+
+    def recover(self, directory):
+        '''
+        Rebuild the intake state from files that are already on disk. Only the
+        UIDs and InstanceNumber are read from each file, the most recently
+        written series (up to max_series) are each handed to the Processor in
+        a single recover message, oldest first, and files that landed but were
+        never processed go through the usual path afterwards.
+        '''
+        with self._lock:
+            self._recover(Path(directory))
+
+    def _recover(self, directory):
+        start = time.perf_counter()
+        pending = list()
+        if self._layout == 'inplace':
+            candidates = self.list_dicoms(directory)
+        else:
+            candidates = list()
+            for series_dir in directory.glob('*/*'):
+                if series_dir.is_dir() and not any(part.startswith('.') for part in series_dir.relative_to(directory).parts):
+                    candidates.extend(self.list_dicoms(series_dir))
+            pending = self.list_dicoms(directory)
+        found = dict()
+        for path in candidates:
+            ds = read_recovery_header(path)
+            if ds is None:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                logger.debug(f'{path} was removed during recovery')
+                continue
+            found.setdefault(ds.SeriesInstanceUID, list()).append((int(ds.InstanceNumber), path, ds, stat))
+        # the series written to most recently are the ones that were running
+        found = sorted(found.values(), key=lambda entries: max(stat.st_mtime for _,_,_,stat in entries))
+        for series in found[-self._max_series:]:
+            series.sort(key=lambda entry: entry[0])
+            ds = self.read_newest(series)
+            if ds is None:
+                continue
+            self._active[ds.SeriesInstanceUID] = ds.StudyInstanceUID
+            if self._layout == 'inplace':
+                self._index[ds.SeriesInstanceUID] = {str(path): instance for instance,path,_,_ in series}
+                for _,path,_,stat in series:
+                    self._recovered[str(path)] = signature(path, stat)
+            else:
+                self._series_dirs[ds.SeriesInstanceUID] = series[-1][1].parent
+            elapsed = time.perf_counter() - start
+            logger.info(f'found {len(series)} volumes of series {ds.SeriesInstanceUID} in {directory} in {elapsed * 1000:.1f} ms')
+            pub.sendMessage(topic('recover', self._namespace), ds=ds, instances=[(instance, str(path)) for instance,path,_,_ in series])
+        for _,path in sorted((stat.st_mtime, path) for path,stat in stat_all(pending)):
+            self.process(FileCreatedEvent(str(path)))
+
+    def read_newest(self, series):
+        '''
+        Full header of the newest volume of a recovered series that is still
+        on disk, None if every file is gone
+        '''
+        for _,path,_,_ in reversed(series):
+            try:
+                return read_header(path)
+            except FileNotFoundError:
+                logger.debug(f'{path} was removed during recovery')
+        return None
+
+    def list_dicoms(self, directory):
+        return [
+            path for path in directory.iterdir()
+            if path.is_file() and self.is_candidate(path)
+        ]
+
+    def is_candidate(self, path):
+        '''
+        Hidden files (e.g., renamed to be removed) and registration output are
+        never dicoms
+        '''
+        return not path.name.startswith('.') and not any(path.match(pattern) for pattern in IGNORE_PATTERNS)
+
+    def process(self, event):
+        with self._lock:
+            self._process(event)
+
+    def _process(self, event):
         path = Path(event.src_path)
+        stamps = {'detect': time.monotonic()}
         try:
-            self.file_size = -1
             if not path.exists():
                 logger.info(f'file {path} no longer exists')
                 return
-            ds = self.read_dicom(path)
-            self.check_series(ds, path)
+            if self.was_recovered(path):
+                logger.debug(f'{path} was already picked up by recovery')
+                return
+            ds = self.read_dicom(path, stamps)
+            if not self.check_series(ds, path):
+                return
             path = self.construct_path(path, ds)
+            stamps['moved'] = time.monotonic()
+            for stage,when in stamps.items():
+                self._timings.stamp(ds.SeriesInstanceUID, int(ds.InstanceNumber), stage, when)
             logger.info(f'publishing message to topic=incoming with ds={path}')
-            pub.sendMessage('incoming', ds=ds, path=path)
+            pub.sendMessage(topic('incoming', self._namespace), ds=ds, path=path)
         except InvalidDicomError as e:
             logger.info(f'not a dicom file {path}')
         except FileNotFoundError as e:
             pass
+        except IncompleteDicomError as e:
+            logger.warning(e)
         except Exception as e:
             logger.info(f'An unexpected error occurred: {e}')
             logger.exception(e, exc_info=True)
 
 
-    @retry((IOError, InvalidDicomError), delay=.01, backoff=1.5, max_delay=1.5, tries=10)
-    def read_dicom(self, dicom):
+    def was_recovered(self, path):
+        '''
+        True if recovery already handed path to the Processor and the file was
+        not written again since. The observer can report a file that recovery
+        listed, while a later file with the same name is a new volume.
+        '''
+        recovered = self._recovered.pop(str(path), None)
+        return recovered is not None and recovered == signature(path)
+
+    def read_dicom(self, dicom, stamps=None):
         """
-        Checking the file size is necessary when mounted over a samba share.
+        Waiting for the file to be complete is necessary when mounted over a samba share.
         the scanner writes dicoms as they come (even if they are incomplete)
         This method ensures the entire dicom is written before being processed
         """
-        new_file_size = dicom.stat().st_size
-        if self.file_size != new_file_size:
-            logger.info(f'file size was {self.file_size}')
-            self.file_size = new_file_size
-            logger.info(f'file size is now {self.file_size}')
-            raise IOError
-        return pydicom.dcmread(dicom, stop_before_pixels=True)
-
-    def check_series(self, ds, old_path):
-        if not hasattr(self, 'first_dcm_series'):
-            logger.info(f'found first series instance uid {ds.SeriesInstanceUID}')
-            self.first_dcm_series = ds.SeriesInstanceUID
-            self.first_dcm_study = ds.StudyInstanceUID
-            return
-
-        if self.first_dcm_series != ds.SeriesInstanceUID:
-            logger.info(f'found new series instance uid: {ds.SeriesInstanceUID}')
-            self.trigger_reset(ds, old_path)
-            self.first_dcm_series = ds.SeriesInstanceUID
-            self.first_dcm_study = ds.StudyInstanceUID
-
-    def trigger_reset(self, ds, old_path):
-        study_name = self.first_dcm_study
-        series_name = self.first_dcm_series
-        dicom_parent = old_path.parent
-        new_path_no_dicom = Path.joinpath(dicom_parent, study_name)#, series_name)
-        logger.debug(f'path to remove: {new_path_no_dicom}')
-        shutil.rmtree(new_path_no_dicom)
-        self.clean_parent(dicom_parent)
-        logger.debug('making it out of clean_parent method')
-        pub.sendMessage('reset')
-
-    def clean_parent(self, path):
-        logger.debug(f'cleaning target dir: {path}')
-        for file in glob.glob(f'{path}/*.dcm'):
-            logger.debug(f'removing {file}')
-            os.remove(file)
+        stamps = dict() if stamps is None else stamps
+        if not self._close_write:
+            waited = self._completeness.wait(dicom)
+            logger.info(f'waited {waited * 1000:.1f} ms for {dicom.name} to be complete')
+        stamps['complete'] = time.monotonic()
+        ds = read_header(dicom)
+        stamps['header'] = time.monotonic()
+        return ds
+
+    def check_series(self, ds, path):
+        '''
+        Track the series of an incoming file and return False if the file
+        belongs to a series that was already evicted
+        '''
+        series = ds.SeriesInstanceUID
+        if series in self._active:
+            self._active.move_to_end(series)
+            return True
+        if series in self._evicted:
+            logger.info(f'ignoring {path} from evicted series {series}')
+            # another series may reuse the file name as soon as it is free
+            trash_path = path.with_name(f'.{path.name}.{time.time_ns()}.trash')
+            os.rename(path, trash_path)
+            remove_later(trash_path)
+            return False
+        logger.info(f'found new series instance uid {series}')
+        self._active[series] = ds.StudyInstanceUID
+        while len(self._active) > self._max_series:
+            self.evict(*self._active.popitem(last=False))
+        return True
+
+    def evict(self, series, study):
+        '''
+        Stop tracking a series. In the move layout its directory is renamed
+        out of the way with a single rename and removed in the background.
+        '''
+        logger.info(f'evicting series {series} of study {study}')
+        self._evicted[series] = study
+        if len(self._evicted) > MAX_EVICTED:
+            self._evicted.popitem(last=False)
+        if self._layout == 'inplace':
+            paths = self._index.pop(series, dict())
+            for path in paths:
+                self._recovered.pop(path, None)
+            remove_later(*paths)
+        else:
+            series_dir = self._series_dirs.pop(series, None)
+            if series_dir and series_dir.exists():
+                trash_path = series_dir.with_name(f'.{series}.{time.time_ns()}.trash')
+                os.rename(series_dir, trash_path)
+                remove_later(trash_path)
+        pub.sendMessage(topic('evict', self._namespace), series=series)
 
     def construct_path(self, old_path, ds):
+        if self._layout == 'inplace':
+            series = self._index.setdefault(ds.SeriesInstanceUID, dict())
+            series[str(old_path)] = int(ds.InstanceNumber)
+            return str(old_path)
+
         study_name = ds.StudyInstanceUID
         series_name = ds.SeriesInstanceUID
         dicom_filename = old_path.name
@@ -119,13 +390,13 @@ class DicomHandler(PatternMatchingEventHandler):
 
         logger.info(f'moving file from {old_path} to {new_path_no_dicom}')
 
-        os.makedirs(new_path_no_dicom, exist_ok=True)
+        if self._series_dirs.get(series_name) != new_path_no_dicom:
+            os.makedirs(new_path_no_dicom, exist_ok=True)
+            self._series_dirs[series_name] = new_path_no_dicom
 
-        try:
-            shutil.move(old_path, new_path_no_dicom)
-        except shutil.Error:
-            pass
-        
-        new_path_with_dicom = Path.joinpath(dicom_parent, study_name, series_name, dicom_filename)
+        new_path_with_dicom = Path.joinpath(new_path_no_dicom, dicom_filename)
+
+        # a rename within the same share never degrades into copy and delete
+        os.rename(old_path, new_path_with_dicom)
 
         return str(new_path_with_dicom)
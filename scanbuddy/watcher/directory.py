@@ -1,39 +1,79 @@
 import time
 import logging
 from pathlib import Path
-from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
+from scanbuddy.watcher import make_observer
 from scanbuddy.watcher.dicom import DicomWatcher
 
 logger = logging.getLogger(__name__)
 
 class DirectoryWatcher:
-    def __init__(self, directory):
+    def __init__(self, directory, observer='polling', completeness='parse', layout='move', namespace=None, max_series=4):
         self._directory = directory
-        self._observer = PollingObserver(timeout=1)
-        self._observer.schedule(
-            DirectoryHandler(),
-            directory
+        self._observer = make_observer(observer, timeout=1)
+        self._handler = DirectoryHandler(
+            observer=observer,
+            completeness=completeness,
+            layout=layout,
+            namespace=namespace,
+            max_series=max_series
         )
+        self._observer.schedule(self._handler, directory)
 
     def start(self):
         logger.info(f'starting directory watcher on {self._directory}')
+        self._handler.resume(self._directory)
         self._observer.start()
 
     def join(self):
         self._observer.join()
 
 class DirectoryHandler(FileSystemEventHandler):
-	def __init__(self, *args, **kwargs):
+	def __init__(self, *args, observer='polling', completeness='parse', layout='move', namespace=None, max_series=4, **kwargs):
 		self._dicomwatcher = None
+		self._observer = observer
+		self._completeness = completeness
+		self._layout = layout
+		self._namespace = namespace
+		self._max_series = max_series
 		super().__init__(*args, **kwargs)
 
 	def on_created(self, event):
 		if event.is_directory:
 			logger.debug(f'on_created fired on {event.src_path}')
-			if self._dicomwatcher:
-				self._dicomwatcher.stop()
-			self._dicomwatcher = DicomWatcher(Path(event.src_path))
-			self._dicomwatcher.start()
+			# files can land before the new directory is noticed
+			self.watch(Path(event.src_path), recover=True)
+
+	def on_moved(self, event):
+		# a session directory renamed into place, the native observer reports
+		# one renamed in from elsewhere as a move without a src_path
+		if event.is_directory and event.dest_path and not Path(event.dest_path).name.startswith('.'):
+			logger.debug(f'on_moved fired on {event.dest_path}')
+			self.watch(Path(event.dest_path), recover=True)
+
+	def resume(self, directory):
+		'''
+		After a restart the most recent session directory already exists and
+		will never fire on_created, so it is recovered and watched right away
+		'''
+		sessions = [path for path in Path(directory).iterdir() if path.is_dir()]
+		if not sessions:
+			return
+		session = max(sessions, key=lambda path: path.stat().st_mtime)
+		logger.info(f'resuming session directory {session}')
+		self.watch(session, recover=True)
+
+	def watch(self, directory, recover=False):
+		if self._dicomwatcher:
+			self._dicomwatcher.stop()
+		self._dicomwatcher = DicomWatcher(
+			directory,
+			observer=self._observer,
+			completeness=self._completeness,
+			layout=self._layout,
+			namespace=self._namespace,
+			max_series=self._max_series
+		)
+		self._dicomwatcher.start(recover=recover)
 
 
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+import pydicom
+import statistics
+from pathlib import Path
+from argparse import ArgumentParser
+from scanbuddy.watcher.dicom import read_header
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def bench(files, parse, repeat):
+    times = list()
+    for _ in range(repeat):
+        for f in files:
+            start = time.perf_counter()
+            parse(f)
+            times.append(time.perf_counter() - start)
+    return times
+
+def full(f):
+    return pydicom.dcmread(f, stop_before_pixels=True)
+
+def main():
+    parser = ArgumentParser(description='compare full and whitelisted dicom header parsing')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('input', type=Path, help='dicom file or directory of dicom files')
+    args = parser.parse_args()
+
+    files = [args.input]
+    if args.input.is_dir():
+        files = sorted(f for f in args.input.iterdir() if f.is_file())
+
+    for name,parse in (('full', full), ('whitelist', read_header)):
+        times = sorted(x * 1000 for x in bench(files, parse, args.repeat))
+        p95 = times[int(0.95 * (len(times) - 1))]
+        logger.info(f'parser={name} files={len(files)} ms/file p50={statistics.median(times):.3f} p95={p95:.3f} max={times[-1]:.3f}')
+
+if __name__ == '__main__':
+    main()
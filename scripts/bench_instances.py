@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import time
+import yaml
+import logging
+import tempfile
+import threading
+import numpy as np
+from argparse import ArgumentParser
+from pydicom.dataset import Dataset
+from pydicom.uid import generate_uid
+from sortedcontainers import SortedDict
+from scanbuddy.bus import bus
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.proc.instances import Instances, freeze
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def main():
+    parser = ArgumentParser(description='time publishing instance snapshots while readers iterate them')
+    parser.add_argument('--volumes', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--series-length', type=int, default=3000, help='volumes handed to Processor.listener')
+    args = parser.parse_args()
+
+    logging.getLogger('scanbuddy').setLevel(logging.WARNING)
+
+    instances = Instances('bench')
+    instances.publish(*(freeze(i, f'{i:06d}.dcm') for i in range(1, args.volumes + 1)))
+
+    done = threading.Event()
+    reads = [0] * args.readers
+    def read(n):
+        while not done.is_set():
+            snapshot = instances.snapshot()
+            sum(1 for entry in snapshot.values() if entry.volreg is not None)
+            reads[n] += 1
+    readers = [threading.Thread(target=read, args=(n,), daemon=True) for n in range(args.readers)]
+    for reader in readers:
+        reader.start()
+
+    start = time.perf_counter()
+    for i in range(args.updates):
+        instance = i % args.volumes + 1
+        instances.publish(freeze(instance, f'{instance:06d}.dcm', [0.0] * 6))
+    elapsed = time.perf_counter() - start
+    done.set()
+    for reader in readers:
+        reader.join()
+    logger.info(f'published {args.updates} versions of {args.volumes} volumes in {elapsed * 1000:.1f} ms, {elapsed / args.updates * 1e6:.1f} us each, while {sum(reads)} full reads ran')
+
+    # what publishing a full copy of the working dict would cost instead
+    working = SortedDict((i, {'path': f'{i:06d}.dcm', 'volreg': None}) for i in range(1, args.volumes + 1))
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        SortedDict((key, dict(value)) for key,value in working.items())
+    elapsed = time.perf_counter() - start
+    logger.info(f'copying the full dict instead takes {elapsed / args.updates * 1e6:.1f} us each')
+
+    # per volume cost of the processor should not grow with the series
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as config_file:
+        yaml.safe_dump({'motion': {'persist': False}}, config_file)
+        config_file.flush()
+        processor = Processor(config=Config(config_file.name))
+    ds = Dataset()
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    elapsed = list()
+    for instance in range(1, args.series_length + 1):
+        ds.InstanceNumber = instance
+        start = time.perf_counter()
+        processor.listener(ds, f'{instance:06d}.dcm')
+        elapsed.append(time.perf_counter() - start)
+    bus.join()
+    tenth = max(1, args.series_length // 10)
+    first,last = np.median(elapsed[:tenth]) * 1e6, np.median(elapsed[-tenth:]) * 1e6
+    logger.info(f'Processor.listener over {args.series_length} volumes: median {first:.1f} us for the first tenth, {last:.1f} us for the last')
+
+if __name__ == '__main__':
+    main()
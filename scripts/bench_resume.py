@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import time
+import yaml
+import logging
+import tempfile
+import numpy as np
+from pubsub import pub
+from pathlib import Path
+from argparse import ArgumentParser
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from scanbuddy.bus import bus
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.proc.volreg import VolReg
+from scanbuddy.proc.persist import MotionFile
+from scanbuddy.watcher.dicom import DicomHandler, IGNORE_PATTERNS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def write_series(directory, study, series, num_vols, rows, cols, frames):
+    '''
+    Write num_vols multi-frame dicoms in the <study>/<series>/ layout left
+    behind by the watcher
+    '''
+    series_dir = Path(directory, study, series)
+    series_dir.mkdir(parents=True)
+    pixels = np.zeros((frames, rows, cols), dtype=np.uint16).tobytes()
+    for instance in range(1, num_vols + 1):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4.1'
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+        ds.StudyInstanceUID = study
+        ds.SeriesInstanceUID = series
+        ds.InstanceNumber = instance
+        ds.SeriesDescription = 'bench_resume'
+        ds.Rows = rows
+        ds.Columns = cols
+        ds.NumberOfFrames = frames
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.PixelData = pixels
+        ds.save_as(series_dir / f'{instance:06d}.dcm', enforce_file_format=True)
+
+def write_motion(directory, study, series, instances):
+    motion = MotionFile.for_series(directory, study, series)
+    for instance in instances:
+        motion.write(instance, np.random.uniform(-0.5, 0.5, 6).tolist())
+    motion.close()
+
+def main():
+    parser = ArgumentParser(description='time crash recovery of a series that is already on disk')
+    parser.add_argument('--volumes', type=int, default=500)
+    parser.add_argument('--missing', type=int, default=5, help='trailing volumes without motion parameters')
+    parser.add_argument('--matrix', type=int, default=64)
+    parser.add_argument('--slices', type=int, default=36)
+    parser.add_argument('--tr', type=float, default=0.8, help='repetition time in seconds')
+    parser.add_argument('--reference', choices=('chain', 'fixed'), default='chain')
+    args = parser.parse_args()
+
+    # scripts log a lot per volume, only the summary matters here
+    logging.getLogger('scanbuddy').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        session = tmp / 'session'
+        study,series = generate_uid(), generate_uid()
+        logger.info(f'writing {args.volumes} volumes to {session}')
+        write_series(session, study, series, args.volumes, args.matrix, args.matrix, args.slices)
+        write_motion(tmp / 'motion', study, series, range(1, args.volumes - args.missing + 1))
+
+        config_file = tmp / 'config.yaml'
+        config_file.write_text(yaml.safe_dump({
+            'motion': {'directory': str(tmp / 'motion')},
+            'volreg': {'reference': {'mode': args.reference}}
+        }))
+        config = Config(config_file)
+        processor = Processor(config=config)
+        volreg = VolReg(config=config, mock=True)
+
+        registered = list()
+        def count(series, instance, volreg):
+            registered.append(instance)
+        pub.subscribe(count, 'registered')
+
+        handler = DicomHandler(ignore_directories=True, ignore_patterns=IGNORE_PATTERNS)
+        start = time.perf_counter()
+        handler.recover(session)
+        bus.join()
+        elapsed = time.perf_counter() - start
+
+        snapshot = processor.series(series).motion.snapshot()
+        logger.info(f'volumes={args.volumes} recovered={snapshot.num_vols} registered={len(registered)} reference={args.reference}')
+        logger.info(f'recovery took {elapsed * 1000:.1f} ms, {elapsed / args.tr:.1%} of a {args.tr} s TR')
+
+if __name__ == '__main__':
+    main()
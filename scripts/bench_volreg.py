@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import time
+import yaml
+import logging
+import tempfile
+import numpy as np
+from pathlib import Path
+from argparse import ArgumentParser
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.proc.motion import COLUMNS
+from scanbuddy.proc.volreg import VolReg
+from scanbuddy.proc.rigid import Volume
+from scanbuddy.timing import timings
+from scanbuddy.watcher.dicom import DicomWatcher
+from simulator import Series
+from scanbuddy.synthetic import write_series, random_walk, load_trajectory, expected
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def main():
+    parser = ArgumentParser(description='measure registration throughput and error against known motion')
+    parser.add_argument('--volumes', type=int, default=50)
+    parser.add_argument('--tr', type=float, default=0.8, help='seconds between volumes, 0 writes them all at once')
+    parser.add_argument('--backend', choices=('rigid', 'afni'), default='rigid')
+    parser.add_argument('--reference', choices=('chain', 'fixed'), default='fixed')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--observer', choices=('polling', 'native'), default='polling')
+    parser.add_argument('--trajectory', type=Path, help='[roll, pitch, yaw, dS, dL, dP] per volume')
+    parser.add_argument('--walk', type=float, default=0.05, help='random walk step size when there is no trajectory')
+    parser.add_argument('--noise', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for registration after the last volume')
+    args = parser.parse_args()
+
+    logging.getLogger('scanbuddy').setLevel(logging.WARNING)
+
+    if args.trajectory:
+        trajectory = load_trajectory(args.trajectory, args.volumes)
+    else:
+        trajectory = random_walk(args.volumes, args.walk, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        logger.info(f'writing {args.volumes} synthetic volumes')
+        dicoms = write_series(tmp / 'source', args.volumes, trajectory=trajectory, noise=args.noise, seed=args.seed)
+
+        config_file = tmp / 'config.yaml'
+        config_file.write_text(yaml.safe_dump({
+            'motion': {'persist': False},
+            'volreg': {
+                'backend': args.backend,
+                'workers': args.workers,
+                # the truth is computed against the first volume, which is not
+                # necessarily the first one picked up when files land at once
+                'reference': {'mode': args.reference, 'index': 1}
+            }
+        }))
+        config = Config(config_file)
+        processor = Processor(config=config)
+        volreg = VolReg(config=config)
+        watcher = DicomWatcher(tmp / 'session', observer=args.observer)
+        watcher.start()
+
+        series = Series(dicoms, tmp / 'session', tr=args.tr)
+        series.start()
+        series.join()
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            state = processor.series()
+            snapshot = state.motion.snapshot() if state else None
+            if snapshot and snapshot.num_vols == args.volumes:
+                break
+            time.sleep(0.05)
+        watcher._observer.stop()
+
+        stamps = timings.volumes().get(state.uid, dict())
+        first = min(started for started,_ in series.written.values())
+        last = max(s['registered'] for s in stamps.values() if 'registered' in s)
+        logger.info(f'registered {snapshot.num_vols} of {args.volumes} volumes in {last - first:.2f} s, {snapshot.num_vols / (last - first):.1f} volumes/s')
+        for stage,values in timings.summary().items():
+            logger.info(f'{stage:>10} ms n={values["count"]} p50={values["p50"]} p95={values["p95"]} max={values["max"]}')
+
+        center = Volume.from_dicom(dicoms[0]).center()
+        truth = expected(trajectory, None if args.reference == 'chain' else 0, center)
+        rows = snapshot.N - 1
+        error = np.abs(snapshot.params - truth[rows])
+        logger.info(f'absolute error against ground truth ({args.reference} reference)')
+        for i,column in enumerate(COLUMNS):
+            unit = 'deg' if i < 3 else 'mm'
+            logger.info(f'{column:>6} mean={error[:, i].mean():.4f} max={error[:, i].max():.4f} {unit}')
+        worst = int(snapshot.N[error.max(axis=1).argmax()])
+        logger.info(f'largest error at instance {worst}')
+
+if __name__ == '__main__':
+    main()
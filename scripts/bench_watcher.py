@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import statistics
+from pathlib import Path
+from argparse import ArgumentParser
+from watchdog.events import FileSystemEventHandler
+from scanbuddy.watcher import make_observer, is_native
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+class LatencyHandler(FileSystemEventHandler):
+    def __init__(self, close_write):
+        self._close_write = close_write
+        self.written = dict()
+        self.latencies = list()
+        self.seen = threading.Event()
+
+    def on_created(self, event):
+        if not self._close_write:
+            self.record(event)
+
+    def on_closed(self, event):
+        if self._close_write:
+            self.record(event)
+
+    def on_moved(self, event):
+        if event.dest_path:
+            self.record(event, event.dest_path)
+
+    def record(self, event, path=None):
+        written = self.written.pop(path or event.src_path, None)
+        if written is not None:
+            self.latencies.append(time.monotonic() - written)
+            self.seen.set()
+
+def bench(kind, directory, num_files, idle, probes, rename=False):
+    # pre-populate the directory so polling has something to rescan
+    for i in range(num_files):
+        Path(directory, f'existing.{i}.dcm').touch()
+    observer = make_observer(kind, timeout=.01)
+    handler = LatencyHandler(close_write=is_native(observer))
+    observer.schedule(handler, str(directory))
+    observer.start()
+    try:
+        # cpu time spent by this process while nothing is arriving
+        cpu = time.process_time()
+        time.sleep(idle)
+        cpu = (time.process_time() - cpu) / idle
+        for i in range(probes):
+            path = os.path.join(directory, f'probe.{i}.dcm')
+            handler.seen.clear()
+            if rename:
+                # written elsewhere on the same file system and renamed in
+                staged = os.path.join(os.path.dirname(directory), f'.{os.path.basename(directory)}.{i}')
+                with open(staged, 'wb') as fo:
+                    fo.write(os.urandom(1024))
+                handler.written[path] = time.monotonic()
+                os.rename(staged, path)
+            else:
+                handler.written[path] = time.monotonic()
+                with open(path, 'wb') as fo:
+                    fo.write(os.urandom(1024))
+            handler.seen.wait(timeout=10)
+    finally:
+        observer.stop()
+        observer.join()
+    return cpu, handler.latencies
+
+def main():
+    parser = ArgumentParser(description='compare polling and native watcher backends')
+    parser.add_argument('--files', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--observers', nargs='+', default=['polling', 'native'])
+    parser.add_argument('--idle', type=float, default=5.0)
+    parser.add_argument('--probes', type=int, default=20)
+    parser.add_argument('--tmpdir', type=Path)
+    parser.add_argument('--rename', action='store_true', help='rename probes into the directory instead of writing them there')
+    args = parser.parse_args()
+
+    for num_files in args.files:
+        for kind in args.observers:
+            directory = tempfile.mkdtemp(dir=args.tmpdir)
+            try:
+                cpu, latencies = bench(kind, directory, num_files, args.idle, args.probes, args.rename)
+            finally:
+                shutil.rmtree(directory)
+            if not latencies:
+                logger.warning(f'{kind} observer did not detect any files')
+                continue
+            latencies = sorted(x * 1000 for x in latencies)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            logger.info(f'files={num_files} observer={kind} detected={len(latencies)}/{args.probes} idle_cpu={cpu:.1%} latency_ms p50={statistics.median(latencies):.2f} p95={p95:.2f} max={latencies[-1]:.2f}')
+
+if __name__ == '__main__':
+    main()
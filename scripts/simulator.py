@@ -1,50 +1,239 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import time
+import json
+import base64
 import shutil
 import logging
 import pydicom
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import urllib.error
+import urllib.request
 from pathlib import Path
 from argparse import ArgumentParser
+from scanbuddy.config import Config
+from scanbuddy.synthetic import write_series
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+START = Path(__file__).parent / 'start.py'
+
+# session directory for several series without --session
+SHARED_SESSION = 'simulator'
+
+class Series(threading.Thread):
+    '''
+    Replay one series into a watched folder on a fixed schedule, one volume
+    every tr seconds, optionally writing each file in chunks the way a slow
+    SMB client does. Series that share a folder need a file name prefix,
+    otherwise they overwrite each other's files.
+    '''
+    def __init__(self, dicoms, dest, tr=0.0, chunk_size=0, chunk_delay=0.0, start=None, prefix=''):
+        super().__init__(daemon=True)
+        self.dicoms = dicoms
+        self.dest = dest
+        self.tr = tr
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.start_time = start or time.time()
+        self.prefix = prefix
+        self.written = dict()
+
+    def run(self):
+        for i,dicom in enumerate(self.dicoms):
+            delay = self.start_time + i * self.tr - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            instance = int(pydicom.dcmread(dicom, stop_before_pixels=True, specific_tags=['InstanceNumber']).InstanceNumber)
+            target = self.dest / f'{self.prefix}{Path(dicom).name}'
+            logger.debug(f'copying {dicom} to {target}')
+            started = time.time()
+            self.copy(dicom, target)
+            self.written[instance] = (started, time.time())
+
+    def copy(self, src, dest):
+        with open(src, 'rb') as fi, open(dest, 'wb') as fo:
+            chunk = fi.read(self.chunk_size or -1)
+            while chunk:
+                fo.write(chunk)
+                fo.flush()
+                chunk = fi.read(self.chunk_size or -1)
+                if chunk and self.chunk_delay:
+                    time.sleep(self.chunk_delay)
+
+class Pipeline:
+    '''
+    Run scripts/start.py against the watched folder and poll its /metrics
+    endpoint for per-volume stamps
+    '''
+    def __init__(self, config, folder, host='127.0.0.1', port=8080, mock=False, start=False, log=None):
+        self._url = f'http://{host}:{port}/metrics?volumes=1'
+        self._auth = self.authorization(config)
+        self._proc = None
+        self._volumes = dict()
+        if start:
+            cmd = [sys.executable, str(START), '-c', str(config), '--folder', str(folder), '--host', host, '--port', str(port)]
+            if mock:
+                cmd.append('--mock')
+            logger.info(f'starting {" ".join(cmd)}')
+            self._log = open(log, 'w') if log else subprocess.DEVNULL
+            self._proc = subprocess.Popen(cmd, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def authorization(self, config):
+        config = Config(config)
+        user = config.find_one('$.app.auth.user')
+        passphrase = os.environ.get(config.find_one('$.app.auth.pass.env', default=''), '')
+        return 'Basic ' + base64.b64encode(f'{user}:{passphrase}'.encode()).decode()
+
+    def fetch(self):
+        req = urllib.request.Request(self._url, headers={'Authorization': self._auth})
+        with urllib.request.urlopen(req, timeout=2) as response:
+            return json.load(response)
+
+    def wait(self, timeout=60.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._proc and self._proc.poll() is not None:
+                raise RuntimeError(f'start.py exited with status {self._proc.returncode}')
+            try:
+                return self.fetch()
+            except (urllib.error.URLError, ConnectionError, OSError):
+                time.sleep(0.25)
+        raise TimeoutError(f'{self._url} did not respond within {timeout} seconds')
+
+    def poll(self):
+        '''
+        Stamps are kept per series, but only for the series the pipeline is
+        tracking, so they are collected throughout the run
+        '''
+        try:
+            volumes = self.fetch().get('volumes', dict())
+        except (urllib.error.URLError, ConnectionError, OSError) as e:
+            logger.debug(f'unable to fetch metrics: {e}')
+            return
+        for series,instances in volumes.items():
+            for instance,stamps in instances.items():
+                self._volumes[(series, int(instance))] = stamps
+
+    def volumes(self):
+        return self._volumes
+
+    def stop(self):
+        if self._proc:
+            self._proc.terminate()
+            self._proc.wait()
+
+def report(series, volumes, stage='published'):
+    for name,s in series.items():
+        lags = list()
+        for instance,(_,written) in sorted(s.written.items()):
+            stamps = volumes.get((name, instance), dict())
+            row = {k: round((v - written) * 1000, 1) for k,v in stamps.items() if k != 'detect'}
+            logger.info(f'series={name} instance={instance} lag_ms={json.dumps(row)}')
+            if stage in stamps:
+                lags.append((stamps[stage] - written) * 1000)
+        if not lags:
+            logger.info(f'series={name} no volume reached {stage}')
+            continue
+        p50,p95 = np.percentile(lags, [50, 95])
+        logger.info(f'series={name} volumes={len(s.written)} {stage}={len(lags)} lag_ms p50={p50:.1f} p95={p95:.1f} max={max(lags):.1f}')
+
+def load(inputs, synthetic, num_series, tmp):
+    '''
+    A list of dicom paths per series, from text files listing one dicom per
+    line, or synthetic series when there are no inputs
+    '''
+    if inputs:
+        series = list()
+        for input in inputs:
+            with open(input) as fo:
+                series.append([Path(line.strip()) for line in fo if line.strip()])
+        return series
+    logger.info(f'writing {num_series} synthetic series of {synthetic} volumes to {tmp}')
+    return [write_series(Path(tmp, str(i)), synthetic) for i in range(num_series)]
+
 def main():
-    parser = ArgumentParser()
-    parser.add_argument('--copy-to', type=Path, required=True)
-    parser.add_argument('--stop-after', type=int) 
-    parser.add_argument('--delay', type=int, default=0)
-    parser.add_argument('input')
+    parser = ArgumentParser(description='replay dicom series into a watched folder at scanner cadence')
+    parser.add_argument('--copy-to', type=Path, required=True, help='folder watched by start.py')
+    parser.add_argument('--stop-after', type=int)
+    parser.add_argument('--tr', '--delay', dest='tr', type=float, default=0.0, help='seconds between volumes')
+    parser.add_argument('--chunk-size', type=int, default=0, help='write files in chunks of this many bytes')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='seconds between chunks')
+    parser.add_argument('--stagger', type=float, default=0.0, help='seconds between the start of each series')
+    parser.add_argument('--session', help='write every series to this session directory (default: one per series, or a shared one for several series)')
+    parser.add_argument('--clear', action='store_true', help='remove existing destination directories')
+    parser.add_argument('--synthetic', type=int, default=100, help='volumes per synthetic series')
+    parser.add_argument('--series', type=int, default=1, help='number of synthetic series')
+    parser.add_argument('-c', '--config', type=Path, help='start.py config, enables lag reporting')
+    parser.add_argument('--start', action='store_true', help='run start.py with --config')
+    parser.add_argument('-m', '--mock', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--log', type=Path, help='start.py output')
+    parser.add_argument('--settle', type=float, default=5.0, help='seconds to wait for the pipeline after the last volume')
+    parser.add_argument('input', nargs='*', type=Path, help='text file listing the dicoms of one series')
     args = parser.parse_args()
 
-    with open(args.input) as fo:
-        cleared = False
-        for i,line in enumerate(fo, start=1):
-            dcmfile = Path(line.strip())
-            ds = pydicom.dcmread(dcmfile)
-            dest = Path(args.copy_to, ds.SeriesInstanceUID)
-            if not dest.exists():
-                cleared = True
-            elif dest.exists() and not cleared:
-                while True:
-                    ans = input(f'delete {dest} [y/n]: ').strip().lower()
-                    match ans:
-                        case 'y':
-                            break
-                        case 'n':
-                            sys.exit(0)
-                        case _:
-                            pass
-                shutil.rmtree(dest)
-                cleared = True
-            dest.mkdir(parents=True, exist_ok=True)
-            logger.info(f'copying {dcmfile} to {dest}')
-            shutil.copy2(dcmfile, dest)
-            if args.stop_after and i >= args.stop_after:
-                break
-            time.sleep(args.delay)
+    if args.start and not args.config:
+        parser.error('--start requires --config')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dicoms = load(args.input, args.synthetic, args.series, tmp)
+        if args.stop_after:
+            dicoms = [files[:args.stop_after] for files in dicoms]
+
+        pipeline = None
+        if args.config:
+            args.copy_to.mkdir(parents=True, exist_ok=True)
+            pipeline = Pipeline(args.config, args.copy_to, args.host, args.port, args.mock, args.start, args.log)
+            pipeline.wait()
+
+        # the watcher stops (and removes) a session directory as soon as the
+        # next one appears, so concurrent series have to share one
+        session = args.session
+        if not session and len(dicoms) > 1:
+            session = SHARED_SESSION
+            logger.info(f'writing {len(dicoms)} series to {Path(args.copy_to, session)}')
+
+        try:
+            start = time.time() + 0.5
+            series = dict()
+            created = set()
+            for i,files in enumerate(dicoms):
+                name = pydicom.dcmread(files[0], stop_before_pixels=True).SeriesInstanceUID
+                dest = Path(args.copy_to, session or name)
+                if dest not in created:
+                    if dest.exists():
+                        if not args.clear:
+                            logger.error(f'{dest} already exists, use --clear to remove it')
+                            sys.exit(1)
+                        shutil.rmtree(dest)
+                    dest.mkdir(parents=True)
+                    created.add(dest)
+                prefix = f'{i:02d}_' if len(dicoms) > 1 else ''
+                series[name] = Series(files, dest, args.tr, args.chunk_size, args.chunk_delay, start + i * args.stagger, prefix)
+            for s in series.values():
+                s.start()
+            while any(s.is_alive() for s in series.values()):
+                if pipeline:
+                    pipeline.poll()
+                time.sleep(0.25)
+            logger.info(f'wrote {sum(len(s.written) for s in series.values())} volumes')
+            if pipeline:
+                deadline = time.time() + args.settle
+                while time.time() < deadline:
+                    pipeline.poll()
+                    time.sleep(0.25)
+                report(series, pipeline.volumes())
+        finally:
+            if pipeline:
+                pipeline.stop()
 
 if __name__ == '__main__':
     main()
@@ -1,60 +1,115 @@
 #!/usr/bin/env python3 -u
 
+import os
+import re
 import sys
 import time
 import logging
 from pubsub import pub
 from pathlib import Path
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from scanbuddy.watcher.directory import DirectoryWatcher
 from scanbuddy.proc import Processor
-from scanbuddy.proc.volreg import VolReg
+from scanbuddy.proc.volreg import VolReg, make_pool
 from scanbuddy.proc.params import Params
 from scanbuddy.view.dash import View
 from scanbuddy.broker.redis import MessageBroker
+from scanbuddy.broker.memory import MemoryBroker
 from scanbuddy.config import Config
 
 logger = logging.getLogger('main')
 logging.basicConfig(level=logging.INFO)
 
+def folder(value):
+    '''
+    A folder to watch, given as PATH or NAME=PATH
+    '''
+    name,sep,path = value.partition('=')
+    if not sep:
+        return None, Path(value)
+    if not re.fullmatch(r'[\w-]+', name):
+        raise ArgumentTypeError(f'scanner name "{name}" may only contain letters, digits, _ and -')
+    return name, Path(path)
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('-m', '--mock', action='store_true')
     parser.add_argument('-c', '--config', required=True, type=Path)
     parser.add_argument('--host', type=str, default='127.0.0.1')
     parser.add_argument('--port', type=int, default=8080)
-    parser.add_argument('--folder', type=Path, required=True)
+    parser.add_argument('--folder', type=folder, action='append', required=True,
+        help='folder to watch as PATH or NAME=PATH, repeat once per scanner')
     parser.add_argument('-v', '--verbose', action='store_true')
     args = parser.parse_args()
 
+    # with several scanners every pipeline gets its own topic namespace
+    folders = args.folder
+    if len(folders) > 1:
+        folders = [(name or path.name, path) for name,path in folders]
+        names = [name for name,_ in folders]
+        if len(set(names)) != len(names):
+            parser.error(f'scanner names must be unique, got {names}')
+        for name in names:
+            if not re.fullmatch(r'[\w-]+', name):
+                parser.error(f'scanner name "{name}" may only contain letters, digits, _ and -')
+
     config = Config(args.config)
 
-    broker = MessageBroker()
-    watcher = DirectoryWatcher(args.folder)
-    processor = Processor()
-    params = Params(
-        broker=broker,
-        config=config
-    )
-    volreg = VolReg(mock=args.mock)
+    if config.find_one('$.broker.backend', default='redis') == 'memory':
+        broker = MemoryBroker()
+    else:
+        broker = MessageBroker.from_config(config)
+
+    # one registration pool for every scanner, sized to the host
+    workers = config.find_one('$.volreg.workers', default=os.cpu_count() if len(folders) > 1 else 1)
+    pool = make_pool(workers)
+
+    pipelines = list()
+    for name,path in folders:
+        pipelines.append((
+            DirectoryWatcher(
+                path,
+                observer=config.find_one('$.watcher.observer', default='polling'),
+                completeness=config.find_one('$.watcher.completeness', default='parse'),
+                layout=config.find_one('$.watcher.layout', default='move'),
+                namespace=name,
+                max_series=config.find_one('$.watcher.max_series', default=4)
+            ),
+            Processor(config=config, namespace=name),
+            Params(
+                broker=broker,
+                config=config,
+                namespace=name
+            ),
+            VolReg(
+                config=config,
+                mock=args.mock,
+                namespace=name,
+                pool=pool
+            )
+        ))
     view = View(
         host=args.host,
         port=args.port,
         config=config,
-        debug=args.verbose
+        debug=args.verbose,
+        broker=broker,
+        scanners=[name for name,_ in folders]
     )
 
     if args.verbose:
         logging.getLogger('scanbuddy.proc').setLevel(logging.DEBUG)
         logging.getLogger('scanbuddy.proc.params').setLevel(logging.DEBUG)
         logging.getLogger('scanbuddy.proc.volreg').setLevel(logging.DEBUG)
+        logging.getLogger('scanbuddy.proc.rigid').setLevel(logging.DEBUG)
         logging.getLogger('scanbuddy.view.dash').setLevel(logging.DEBUG)
    
     # logging from this module is useful, but noisy
     logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
-    # start the watcher and view
-    watcher.start()
+    # start the watchers and view
+    for watcher,*_ in pipelines:
+        watcher.start()
     view.forever()
 
 if __name__ == '__main__':
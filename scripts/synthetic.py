@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import logging
+from pathlib import Path
+from argparse import ArgumentParser
+from scanbuddy.synthetic import write_series, random_walk, load_trajectory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def main():
+    parser = ArgumentParser(description='write a synthetic Siemens-like EPI series with known motion')
+    parser.add_argument('--volumes', type=int, default=100)
+    parser.add_argument('--matrix', type=int, default=64)
+    parser.add_argument('--slices', type=int, default=32)
+    parser.add_argument('--tr', type=float, default=0.8, help='repetition time written to the header')
+    parser.add_argument('--trajectory', type=Path, help='[roll, pitch, yaw, dS, dL, dP] per volume')
+    parser.add_argument('--walk', type=float, default=0.0, help='random walk step size when there is no trajectory')
+    parser.add_argument('--noise', type=float, default=0.0, help='standard deviation of added gaussian noise')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--coil', default='HeadNeck_64')
+    parser.add_argument('--coil-elements', default='HC1-7')
+    parser.add_argument('output', type=Path)
+    args = parser.parse_args()
+
+    trajectory = None
+    if args.trajectory:
+        trajectory = load_trajectory(args.trajectory, args.volumes)
+    elif args.walk:
+        trajectory = random_walk(args.volumes, args.walk, args.seed)
+
+    paths = write_series(
+        args.output,
+        args.volumes,
+        rows=args.matrix,
+        cols=args.matrix,
+        slices=args.slices,
+        trajectory=trajectory,
+        noise=args.noise,
+        seed=args.seed,
+        tr=args.tr,
+        coil=args.coil,
+        coil_elements=args.coil_elements
+    )
+    logger.info(f'wrote {len(paths)} volumes and truth.1D to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,6 @@ requires = [
     'sortedcontainers',
     'plotly',
     'pandas',
-    'retry',
     'redis',
     'pyyaml',
     'jsonpath-ng',
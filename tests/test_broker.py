@@ -0,0 +1,34 @@
+import pytest
+from scanbuddy.broker.memory import MemoryBroker
+from scanbuddy.broker.redis import MessageBroker
+
+TOPIC = 'scanbuddy_messages'
+
+@pytest.fixture(params=['memory', 'redis'])
+def broker(request):
+    if request.param == 'memory':
+        return MemoryBroker()
+    fakeredis = pytest.importorskip('fakeredis')
+    broker = MessageBroker()
+    broker._conn = fakeredis.FakeRedis(decode_responses=True)
+    return broker
+
+def test_messages_in_the_same_second_are_delivered_in_order(broker):
+    last_id = broker.last_id(TOPIC)
+    broker.publish(TOPIC, 'first')
+    broker.publish(TOPIC, 'second')
+    messages = broker.read(TOPIC, last_id, block=10)
+    assert [message for _,message in messages] == ['first', 'second']
+
+def test_reader_resumes_from_its_offset(broker):
+    broker.publish(TOPIC, 'before')
+    last_id = broker.last_id(TOPIC)
+    broker.publish(TOPIC, 'first')
+    messages = broker.read(TOPIC, last_id, block=10)
+    assert [message for _,message in messages] == ['first']
+    last_id = messages[-1][0]
+    broker.publish(TOPIC, 'second')
+    broker.publish(TOPIC, 'third')
+    messages = broker.read(TOPIC, last_id, block=10)
+    assert [message for _,message in messages] == ['second', 'third']
+    assert broker.read(TOPIC, messages[-1][0], block=10) == list()
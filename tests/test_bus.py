@@ -0,0 +1,26 @@
+import time
+from pubsub import pub
+from scanbuddy.bus import Bus
+from scanbuddy.topics import topic
+
+NAMESPACE = 'test-bus'
+
+def test_join_waits_for_messages_being_delivered():
+    bus = Bus()
+    upstream = bus.stage('upstream', NAMESPACE)
+    downstream = bus.stage('downstream', NAMESPACE)
+    delivered = list()
+    def forward(value):
+        time.sleep(0.1)
+        pub.sendMessage(topic('forwarded', NAMESPACE), value=value)
+    def record(value):
+        time.sleep(0.1)
+        delivered.append(value)
+    upstream.subscribe(forward, 'incoming')
+    downstream.subscribe(record, 'forwarded')
+    pub.sendMessage(topic('incoming', NAMESPACE), value=1)
+    # the upstream thread takes the message off its queue right away
+    time.sleep(0.02)
+    bus.join()
+    assert delivered == [1]
+    assert upstream.pending() == downstream.pending() == 0
@@ -0,0 +1,37 @@
+from scanbuddy.proc.cache import VolumeCache
+
+def test_pinned_entries_outlive_eviction():
+    evicted = list()
+    cache = VolumeCache(maxsize=1, on_evict=evicted.append)
+    pins = list()
+    cache.get_or_load('a', lambda: 'a.nii', pins)
+    cache.get_or_load('b', lambda: 'b.nii')
+    assert evicted == list()
+    assert 'a' in cache
+    cache.unpin(*pins)
+    assert evicted == ['a.nii']
+    assert 'b' in cache
+
+def test_pins_are_counted():
+    evicted = list()
+    cache = VolumeCache(maxsize=1, on_evict=evicted.append)
+    first,second = list(),list()
+    cache.get_or_load('a', lambda: 'a.nii', first)
+    cache.get_or_load('a', lambda: 'a.nii', second)
+    cache.put('b', 'b.nii')
+    cache.unpin(*first)
+    assert evicted == list()
+    cache.unpin(*second)
+    assert evicted == ['a.nii']
+
+def test_clear_waits_for_pinned_entries():
+    evicted = list()
+    cache = VolumeCache(maxsize=4, on_evict=evicted.append)
+    pins = list()
+    cache.get_or_load('a', lambda: 'a.nii', pins)
+    cache.put('b', 'b.nii')
+    cache.clear()
+    assert evicted == ['b.nii']
+    cache.unpin(*pins)
+    assert evicted == ['b.nii', 'a.nii']
+    assert len(cache) == 0
@@ -0,0 +1,61 @@
+import io
+import os
+import pytest
+import numpy as np
+from pydicom.uid import generate_uid
+from scanbuddy.synthetic import dataset
+from scanbuddy.watcher.complete import ParseCompleteness, IncompleteDicomError
+
+SHAPE = (4, 16, 16)
+
+@pytest.fixture
+def dicom():
+    ds = dataset(SHAPE, 1, generate_uid(), generate_uid())
+    ds.PixelData = np.full(SHAPE, 100, dtype=np.uint16).tobytes()
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    data = buffer.getvalue()
+    return data, len(data) - len(ds.PixelData)
+
+def touch(path, ns):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + ns))
+
+def test_streamed_file_is_complete_when_written(tmp_path, dicom):
+    data,header = dicom
+    path = tmp_path / 'streamed.dcm'
+    completeness = ParseCompleteness()
+    path.write_bytes(data[:header + 10])
+    assert not completeness.is_complete(path)
+    path.write_bytes(data)
+    assert completeness.is_complete(path)
+
+def test_preallocated_file_must_settle(tmp_path, dicom):
+    data,header = dicom
+    path = tmp_path / 'preallocated.dcm'
+    completeness = ParseCompleteness()
+    # the header is on disk and the pixel data is still zero-filled
+    path.write_bytes(data[:header] + bytes(len(data) - header))
+    assert not completeness.is_complete(path)
+    # the writer fills in the pixel data
+    with open(path, 'r+b') as fo:
+        fo.seek(header)
+        fo.write(data[header:])
+    touch(path, 1000)
+    assert not completeness.is_complete(path)
+    assert completeness.is_complete(path)
+
+def test_preallocated_header_is_not_complete(tmp_path, dicom):
+    data,_ = dicom
+    path = tmp_path / 'empty.dcm'
+    path.write_bytes(bytes(len(data)))
+    completeness = ParseCompleteness(timeout=0.05)
+    with pytest.raises(IncompleteDicomError):
+        completeness.wait(path)
+
+def test_complete_file_waits_one_interval(tmp_path, dicom):
+    data,_ = dicom
+    path = tmp_path / 'complete.dcm'
+    path.write_bytes(data)
+    completeness = ParseCompleteness(interval=0.01)
+    assert completeness.wait(path) >= 0.01
@@ -0,0 +1,70 @@
+import yaml
+import pytest
+from pubsub import pub
+from pydicom.uid import generate_uid
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.topics import topic
+from scanbuddy.synthetic import dataset
+
+class Tasks:
+    '''
+    (moving, base) InstanceNumbers of every registration task, pypubsub only
+    keeps a weak reference to the listener
+    '''
+    def __init__(self, namespace):
+        self.messages = list()
+        pub.subscribe(self.listener, topic('volreg', namespace))
+
+    def listener(self, tasks):
+        self.messages.append([(moving.instance, base.instance) for moving,base in tasks])
+
+    def take(self):
+        messages,self.messages = self.messages,list()
+        return messages
+
+@pytest.fixture
+def namespace(request):
+    return request.node.name
+
+@pytest.fixture
+def processor(tmp_path, namespace):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(yaml.safe_dump({
+        'volreg': {
+            'reference': {'mode': 'fixed', 'index': 3}
+        },
+        'motion': {
+            'persist': False
+        }
+    }))
+    return Processor(config=Config(config_file), namespace=namespace)
+
+def send(processor, series, instance):
+    processor.listener(dataset((2, 4, 4), instance, series, series), f'{instance}.dcm')
+
+def test_volumes_before_the_base_wait_for_it(processor, namespace):
+    tasks = Tasks(namespace)
+    series = generate_uid()
+    send(processor, series, 2)
+    send(processor, series, 1)
+    assert tasks.take() == [[], []]
+    send(processor, series, 3)
+    assert tasks.take() == [[(1, 3), (2, 3)]]
+
+def test_base_records_zeros(processor):
+    series = generate_uid()
+    send(processor, series, 3)
+    state = processor.series(series)
+    assert state.base == 3
+    assert state.instances.volreg(3) == [0.0] * 6
+    assert state.motion.snapshot().N.tolist() == [3]
+
+def test_late_arrival_is_registered_once(processor, namespace):
+    tasks = Tasks(namespace)
+    series = generate_uid()
+    for instance in (3, 4, 6):
+        send(processor, series, instance)
+    assert tasks.take() == [[], [(4, 3)], [(6, 3)]]
+    send(processor, series, 5)
+    assert tasks.take() == [[(5, 3)]]
@@ -0,0 +1,47 @@
+import yaml
+import pytest
+from pydicom.uid import generate_uid
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.proc.instances import InstanceTable, MAX_INSTANCE
+from scanbuddy.synthetic import dataset
+
+@pytest.fixture
+def processor(tmp_path):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(yaml.safe_dump({
+        'motion': {
+            'persist': False
+        }
+    }))
+    return Processor(config=Config(config_file), namespace='test-instances')
+
+@pytest.mark.parametrize('instance', [-1, MAX_INSTANCE + 1, 10000001])
+def test_table_rejects_out_of_range_instances(instance):
+    table = InstanceTable()
+    with pytest.raises(ValueError):
+        table.add(instance, 'volume.dcm')
+    assert len(table) == 0
+
+def test_processor_ignores_out_of_range_instances(processor):
+    series = generate_uid()
+    ds = dataset((2, 4, 4), 1, generate_uid(), series)
+    processor.listener(ds, 'first.dcm')
+    ds.InstanceNumber = -1
+    processor.listener(ds, 'negative.dcm')
+    ds.InstanceNumber = 10000001
+    processor.listener(ds, 'huge.dcm')
+    state = processor.series(series)
+    assert list(state.instances.keys()) == [1]
+    assert list(state.published.snapshot().keys()) == [1]
+    assert state.instances.path(1) == 'first.dcm'
+
+def test_recovery_skips_out_of_range_instances(processor):
+    series = generate_uid()
+    ds = dataset((2, 4, 4), 2, generate_uid(), series)
+    processor.recover(ds, [(-1, 'negative.dcm'), (1, 'first.dcm'), (2, 'second.dcm')])
+    state = processor.series(series)
+    assert list(state.instances.keys()) == [1, 2]
+    ds.SeriesInstanceUID = generate_uid()
+    processor.recover(ds, [(-5, 'negative.dcm')])
+    assert processor.series(ds.SeriesInstanceUID) is None
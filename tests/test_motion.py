@@ -0,0 +1,28 @@
+import numpy as np
+from scanbuddy.proc.motion import MotionStore
+
+def row(value):
+    return [value] * 6
+
+def test_snapshot_is_cached_until_the_next_update():
+    store = MotionStore(capacity=4)
+    store.update(1, row(0.1))
+    snapshot = store.snapshot()
+    assert store.snapshot() is snapshot
+    store.update(2, row(0.2))
+    assert store.snapshot() is not snapshot
+    assert snapshot.N.tolist() == [1]
+
+def test_snapshot_rows_match_after_appends_and_rewrites():
+    store = MotionStore(capacity=4)
+    for instance in (1, 2, 3, 5, 8, 9, 10):
+        store.update(instance, row(instance))
+    before = store.snapshot()
+    store.update(4, row(4))
+    store.update(2, row(20))
+    snapshot = store.snapshot()
+    assert snapshot.N.tolist() == [1, 2, 3, 4, 5, 8, 9, 10]
+    np.testing.assert_array_equal(snapshot.params[:, 0], [1, 20, 3, 4, 5, 8, 9, 10])
+    assert before.N.tolist() == [1, 2, 3, 5, 8, 9, 10]
+    assert before.params[1, 0] == 2
+    assert not snapshot.params.flags.writeable
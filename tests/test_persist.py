@@ -0,0 +1,58 @@
+import os
+import time
+import yaml
+import pytest
+from pydicom.uid import generate_uid
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.proc.persist import MotionFile, prune
+from scanbuddy.synthetic import dataset
+
+DAY = 86400
+
+@pytest.fixture
+def motion_dir(tmp_path):
+    return tmp_path / 'motion'
+
+@pytest.fixture
+def processor(tmp_path, motion_dir, request):
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(yaml.safe_dump({
+        'motion': {
+            'directory': str(motion_dir),
+            'retention': 7
+        }
+    }))
+    return Processor(config=Config(config_file), namespace=request.node.name)
+
+def write_motion(directory, series, instances, age=0):
+    motion = MotionFile.for_series(directory, generate_uid(), series)
+    for instance in instances:
+        motion.write(instance, [0.5] * 6)
+    motion.close()
+    path = directory / f'{series}.motion'
+    then = time.time() - age
+    os.utime(path, (then, then))
+    return path
+
+def test_resent_series_starts_without_old_rows(processor, motion_dir):
+    series = generate_uid()
+    write_motion(motion_dir, series, range(1, 6))
+    processor.listener(dataset((2, 4, 4), 1, series, series), '1.dcm')
+    state = processor.series(series)
+    assert state.motion.snapshot().num_vols == 0
+    assert dict(state.file.items()) == dict()
+
+def test_old_motion_files_are_removed(processor, motion_dir):
+    old = write_motion(motion_dir, generate_uid(), [1], age=8 * DAY)
+    recent = write_motion(motion_dir, generate_uid(), [1], age=6 * DAY)
+    processor.listener(dataset((2, 4, 4), 1, generate_uid(), generate_uid()), '1.dcm')
+    assert not old.exists()
+    assert recent.exists()
+
+def test_prune_keeps_active_series(motion_dir):
+    series = generate_uid()
+    path = write_motion(motion_dir, series, [1], age=8 * DAY)
+    assert prune(motion_dir, 7 * DAY, keep={series}) == 0
+    assert path.exists()
+    assert prune(motion_dir, 7 * DAY) == 1
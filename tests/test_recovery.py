@@ -0,0 +1,135 @@
+import os
+import yaml
+import pytest
+from pubsub import pub
+from pydicom.uid import generate_uid
+from watchdog.events import FileCreatedEvent
+from scanbuddy.bus import bus
+from scanbuddy.config import Config
+from scanbuddy.proc import Processor
+from scanbuddy.proc.persist import MotionFile
+from scanbuddy.topics import topic
+from scanbuddy.synthetic import write_series
+from scanbuddy.watcher import dicom as dicom_module
+from scanbuddy.watcher.dicom import DicomHandler, IGNORE_PATTERNS, read_header
+
+SHAPE = {'rows': 8, 'cols': 8, 'slices': 4}
+
+class Collector:
+    '''
+    Every message of a topic, pypubsub only keeps a weak reference to the
+    listener so the collector has to outlive the test
+    '''
+    def __init__(self, name, namespace):
+        self.messages = list()
+        pub.subscribe(self.listener, topic(name, namespace))
+
+    def listener(self, **kwargs):
+        raise NotImplementedError()
+
+class Tasks(Collector):
+    def __init__(self, namespace):
+        super().__init__('volreg', namespace)
+
+    def listener(self, tasks):
+        self.messages.extend((moving.instance, base.instance) for moving,base in tasks)
+
+class Recovered(Collector):
+    def __init__(self, namespace):
+        super().__init__('recover', namespace)
+
+    def listener(self, ds, instances):
+        self.messages.append([instance for instance,_ in instances])
+
+class Incoming(Collector):
+    def __init__(self, namespace):
+        super().__init__('incoming', namespace)
+
+    def listener(self, ds, path):
+        self.messages.append(path)
+
+def make_processor(tmp_path, namespace, reference):
+    config_file = tmp_path / f'{namespace}.yaml'
+    config_file.write_text(yaml.safe_dump({
+        'volreg': {
+            'reference': reference
+        },
+        'motion': {
+            'directory': str(tmp_path / 'motion')
+        }
+    }))
+    return Processor(config=Config(config_file), namespace=namespace)
+
+def make_handler(layout, namespace):
+    return DicomHandler(
+        ignore_directories=True,
+        ignore_patterns=IGNORE_PATTERNS,
+        layout=layout,
+        namespace=namespace
+    )
+
+def test_move_layout_only_queues_volumes_without_motion(tmp_path):
+    namespace = 'test-recover-move'
+    study,series = generate_uid(),generate_uid()
+    session = tmp_path / 'session'
+    write_series(session / study / series, 6, study, series, **SHAPE)
+    processor = make_processor(tmp_path, namespace, {'mode': 'chain'})
+    motion = MotionFile.for_series(tmp_path / 'motion', study, series)
+    for instance in (1, 2, 3):
+        motion.write(instance, [0.1] * 6)
+    motion.close()
+    volreg = Tasks(namespace)
+    make_handler('move', namespace).recover(session)
+    bus.join()
+    assert volreg.messages == [(4, 3), (5, 4), (6, 5)]
+    state = processor.series(series)
+    assert list(state.instances.keys()) == [1, 2, 3, 4, 5, 6]
+    assert state.instances.volreg(2) == pytest.approx([0.1] * 6)
+
+def test_inplace_recovered_file_is_not_processed_twice(tmp_path):
+    namespace = 'test-recover-inplace'
+    session = tmp_path / 'session'
+    paths = write_series(session, 3, **SHAPE)
+    recovered = Recovered(namespace)
+    incoming = Incoming(namespace)
+    handler = make_handler('inplace', namespace)
+    handler.recover(session)
+    assert recovered.messages == [[1, 2, 3]]
+    # the observer reports a file recovery already handed over
+    handler.process(FileCreatedEvent(str(paths[1])))
+    assert incoming.messages == list()
+    # the scanner sends a new volume under the same name
+    data = paths[2].read_bytes()
+    paths[2].unlink()
+    paths[2].write_bytes(data)
+    stat = os.stat(paths[2])
+    os.utime(paths[2], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    handler.process(FileCreatedEvent(str(paths[2])))
+    assert incoming.messages == [str(paths[2])]
+
+def test_recovery_skips_files_removed_during_the_scan(tmp_path, monkeypatch):
+    namespace = 'test-recover-removed'
+    session = tmp_path / 'session'
+    paths = write_series(session, 3, **SHAPE)
+    read_recovery_header = dicom_module.read_recovery_header
+    def remove_newest(path):
+        ds = read_recovery_header(path)
+        if path == paths[-1]:
+            path.unlink()
+        return ds
+    monkeypatch.setattr(dicom_module, 'read_recovery_header', remove_newest)
+    recovered = Recovered(namespace)
+    make_handler('inplace', namespace).recover(session)
+    assert recovered.messages == [[1, 2]]
+
+def test_fixed_base_missing_from_recovered_volumes(tmp_path):
+    namespace = 'test-recover-fixed'
+    processor = make_processor(tmp_path, namespace, {'mode': 'fixed', 'index': 1})
+    paths = write_series(tmp_path / 'series', 5, **SHAPE)
+    volreg = Tasks(namespace)
+    processor.recover(read_header(paths[-1]), [(i, str(paths[i - 1])) for i in (3, 4, 5)])
+    assert volreg.messages == list()
+    processor.listener(read_header(paths[0]), str(paths[0]))
+    assert volreg.messages == [(3, 1), (4, 1), (5, 1)]
+    state = processor.series(read_header(paths[0]).SeriesInstanceUID)
+    assert state.instances.volreg(1) == [0.0] * 6
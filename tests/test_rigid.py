@@ -0,0 +1,72 @@
+import yaml
+import shutil
+import pytest
+import numpy as np
+from pydicom.uid import generate_uid
+from scanbuddy.config import Config, ConfigError
+from scanbuddy.proc.instances import Entry
+from scanbuddy.proc.rigid import Volume
+from scanbuddy.proc.volreg import VolReg
+from scanbuddy.synthetic import dataset, expected, write_series
+
+# [roll, pitch, yaw, dS, dL, dP] of each volume, registered to the first
+TRAJECTORY = np.array([
+    [0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 1.5, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 0.0, -1.0, 0.8],
+    [2.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+    [0.0, -1.5, 1.0, 0.0, 0.0, 0.0],
+    [1.0, 0.5, -0.8, 0.6, -0.4, 0.3]
+])
+
+# degrees and millimeters, well below the motion of every volume so that a
+# sign, order or axis mismatch fails while interpolation error does not
+TOLERANCE = 0.25
+
+has_afni = shutil.which('3dvolreg') and shutil.which('dcm2niix')
+
+@pytest.fixture(scope='module')
+def series(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('series')
+    paths = write_series(directory, len(TRAJECTORY), trajectory=TRAJECTORY)
+    uid = generate_uid()
+    entries = [Entry(uid, i, str(path)) for i,path in enumerate(paths, start=1)]
+    center = Volume.from_dicom(paths[0]).center()
+    return entries, expected(TRAJECTORY, 0, center)
+
+def make_volreg(tmp_path, backend):
+    config_file = tmp_path / f'{backend}.yaml'
+    config_file.write_text(yaml.safe_dump({
+        'volreg': {
+            'backend': backend,
+            'workers': 0
+        }
+    }))
+    return VolReg(config=Config(config_file), namespace=f'test-{backend}')
+
+def register(tmp_path, backend, entries):
+    volreg = make_volreg(tmp_path, backend)
+    base,moving = entries[0],entries[1:]
+    if backend == 'rigid':
+        return np.array(volreg.run_rigid(base, moving))
+    return np.array(volreg.run_afni(base, moving))
+
+def test_rigid_recovers_motion(tmp_path, series):
+    entries,truth = series
+    result = register(tmp_path, 'rigid', entries)
+    np.testing.assert_allclose(result, truth[1:], atol=TOLERANCE)
+
+@pytest.mark.skipif(not has_afni, reason='AFNI (3dvolreg) and dcm2niix are not installed')
+def test_rigid_matches_afni(tmp_path, series):
+    entries,truth = series
+    afni = register(tmp_path, 'afni', entries)
+    rigid = register(tmp_path, 'rigid', entries)
+    np.testing.assert_allclose(afni, truth[1:], atol=TOLERANCE)
+    np.testing.assert_allclose(rigid, afni, atol=TOLERANCE)
+
+def test_rigid_rejects_2d_images():
+    ds = dataset((1, 32, 32), 1, generate_uid(), generate_uid())
+    del ds.NumberOfFrames
+    ds.PixelData = np.zeros((32, 32), dtype=np.uint16).tobytes()
+    with pytest.raises(ConfigError, match='mosaic'):
+        Volume.from_dataset(ds)
@@ -0,0 +1,73 @@
+import os
+import time
+import yaml
+import pytest
+import threading
+from pathlib import Path
+from scanbuddy.config import Config
+from scanbuddy.proc import volreg as volreg_module
+from scanbuddy.proc.volreg import VolReg
+from scanbuddy.proc.instances import Entry
+
+def fake_dcm2niix(cmd, **kwargs):
+    '''
+    Writes what dcm2niix would for one dicom, the .nii holds the dicom path
+    '''
+    out_dir = cmd[cmd.index('-o') + 1]
+    name = cmd[cmd.index('-f') + 1]
+    Path(out_dir, f'{name}.nii').write_text(cmd[-1])
+    return b''
+
+def fake_afni(cmd, **kwargs):
+    '''
+    dcm2niix as above, 3dTcat writes its prefix and 3dvolreg writes one
+    motion row per input, then waits so that concurrent calls overlap
+    '''
+    if cmd[0] == 'dcm2niix':
+        return fake_dcm2niix(cmd)
+    if cmd[0] == '3dTcat':
+        Path(cmd[cmd.index('-prefix') + 1]).touch()
+        return b''
+    Path(cmd[cmd.index('-1Dfile') + 1]).write_text('0 0 0 1 2 3\n')
+    time.sleep(0.05)
+    return b''
+
+@pytest.fixture
+def volreg(tmp_path, monkeypatch):
+    monkeypatch.setattr(volreg_module.subprocess, 'check_output', fake_dcm2niix)
+    config_file = tmp_path / 'config.yaml'
+    config_file.write_text(yaml.safe_dump({'volreg': {'workers': 0}}))
+    return VolReg(config=Config(config_file), namespace='test-volreg')
+
+def test_same_instance_of_two_series_converts_to_separate_files(tmp_path, volreg):
+    session = tmp_path / 'session'
+    session.mkdir()
+    first,second = session / 'a.dcm',session / 'b.dcm'
+    first.touch()
+    second.touch()
+    nii1 = volreg.run_dcm2niix(str(first), 5)
+    nii2 = volreg.run_dcm2niix(str(second), 5)
+    assert nii1 != nii2
+    assert Path(nii1).read_text() == str(first)
+    assert Path(nii2).read_text() == str(second)
+    volreg.evict(nii1)
+    assert not os.path.exists(os.path.dirname(nii1))
+    assert Path(nii2).read_text() == str(second)
+
+def test_concurrent_registrations_of_one_volume_do_not_collide(tmp_path, volreg, monkeypatch):
+    monkeypatch.setattr(volreg_module.subprocess, 'check_output', fake_afni)
+    series = 'series'
+    for name in ('1.dcm', '2.dcm'):
+        (tmp_path / name).touch()
+    base = Entry(series, 1, str(tmp_path / '1.dcm'))
+    moving = Entry(series, 2, str(tmp_path / '2.dcm'))
+    results = list()
+    def register():
+        results.append(volreg.run_afni(base, [moving]))
+    threads = [threading.Thread(target=register) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [[[0, 0, 0, 1, 2, 3]]] * 2
+    assert not list(tmp_path.glob('.volreg_*'))